@@ -0,0 +1,59 @@
+"""
+Measures how long a fresh worker process takes to get the app ready, which is
+paid every time gunicorn recycles a worker. Each case is timed in new python
+processes, so that nothing is already imported:
+
+	import		: importing flask_main (what every worker pays without --preload)
+	create_app	: importing flask_main and configuring the app
+	preload		: the same, also importing the Google client modules and fetching
+				  the Calendar API description, as create_app(preload=True) does
+				  in the gunicorn master
+	eager		: the same work, as it was done before the Google client
+				  modules were loaded lazily
+
+Run from the meetings directory, where credentials.ini is:
+	python3 benchmarks/bench_startup.py [--runs N]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CASES = [
+	("import", "import flask_main"),
+	("create_app", "import flask_main; flask_main.create_app()"),
+	("preload", "import flask_main; flask_main.create_app(preload=True)"),
+	("eager", "from oauth2client import client; import httplib2; from apiclient import discovery; "
+			  "import flask_main; flask_main.create_app()"),
+]
+
+TIMER = "import time; t = time.perf_counter(); {}; print(time.perf_counter() - t)"
+
+
+def time_case(statement, runs):
+	"""Returns the times, in seconds, of running statement in 'runs' fresh processes"""
+	times = []
+	for run in range(runs):
+		output = subprocess.check_output([sys.executable, "-c", TIMER.format(statement)],
+										 cwd=HERE, stderr=subprocess.DEVNULL)
+		times.append(float(output.decode().split()[-1]))
+	return times
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Worker startup benchmark")
+	parser.add_argument("-n", "--runs", type=int, default=10, help="Processes started per case")
+	args = parser.parse_args()
+
+	print("{:<12} {:>10} {:>10}   ({} runs)".format("case", "median ms", "min ms", args.runs))
+	for name, statement in CASES:
+		times = time_case(statement, args.runs)
+		print("{:<12} {:>10.1f} {:>10.1f}".format(name, statistics.median(times) * 1000, min(times) * 1000))
+
+
+if __name__ == "__main__":
+	main()
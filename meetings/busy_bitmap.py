@@ -0,0 +1,147 @@
+"""
+Rasterizes busy times into bitmaps, to answer questions like "what fraction of
+9-5 is busy on each day across these calendars" without comparing instances
+pairwise. The query window is cut into slots of a few minutes, and each
+calendar's busy time becomes a bitset (a python int) with one bit per slot that
+is set when the calendar is busy during any part of that slot. The union or
+intersection of calendars is then a single | or & of their bitsets, and the busy
+time within a day's time range is the number of set bits in that range.
+
+Main Functions:
+utilization					: per-day busy fractions of each calendar, of their union and intersection
+
+Helper Functions:
+make_grid
+slot_range
+rasterize
+count_busy
+"""
+
+import arrow
+
+from from_gcal import list_availabilities_btwn_dates
+
+SLOT_MINUTES = (5, 15, 30)		# Slot sizes that can be asked for
+
+
+#############################
+#
+#  Main Functions
+#
+#############################
+
+def utilization(instances, begin_date, end_date, begin_time, end_time, slot_minutes=15,
+				selected_cal=None):
+	"""
+	Summarizes how busy the time range of each date in the date range is, for each
+	selected calendar, and for all of them together. A selected calendar with no
+	instances is free all the time, so nothing is busy on all calendars at once.
+
+	Args:
+		instances:		list, of our instance dicts as returned by list_instances_btwn_times_in_dates()
+		begin_date:		str, an isoformatted time containing the start date and tz
+		end_date:		str, an isoformatted time containing the end date and tz
+		begin_time:		str, an isoformatted time containing the start of the time range
+		end_time:		str, an isoformatted time containing the end of the time range
+		slot_minutes:	int, the resolution of the bitmaps, one of SLOT_MINUTES
+		selected_cal:	list, of the ids of the selected calendars. Defaults to the
+						calendars the instances come from
+
+	Returns:
+		a dict, with the busy fraction (0 to 1) of each day:
+			"any":			when at least one calendar is busy (the union)
+			"all":			when all calendars are busy (the intersection)
+			"calendars":	of each calendar alone
+		and the same fractions over the whole date range in "total"
+	"""
+	assert slot_minutes in SLOT_MINUTES
+
+	days = list_availabilities_btwn_dates(begin_date, end_date, begin_time, end_time)
+	for day in days:
+		# Same begin and end time means the whole day, as in really_between_times()
+		if day['bt'] == day['et']:
+			day['et'] = arrow.get(day['bt']).shift(days=+1).isoformat()
+	grid = make_grid(days[0]['bt'], days[-1]['et'], slot_minutes)
+
+	by_calendar = {cal_id: 0 for cal_id in selected_cal or []}
+	for instance in instances:
+		bits = rasterize(grid, instance['begin_datetime'], instance['end_datetime'])
+		for cal_id in instance.get('cal_ids') or ["unknown"]:
+			by_calendar[cal_id] = by_calendar.get(cal_id, 0) | bits
+
+	union = 0
+	for bits in by_calendar.values():
+		union |= bits
+	intersection = grid['full'] if by_calendar else 0
+	for bits in by_calendar.values():
+		intersection &= bits
+
+	windows = [(day, slot_range(grid, day['bt'], day['et'])) for day in days]
+	def fractions(bits):
+		busy  = [count_busy(bits, first, last) for day, (first, last) in windows]
+		sizes = [last - first for day, (first, last) in windows]
+		per_day = [b / s if s else 0.0 for b, s in zip(busy, sizes)]
+		total = sum(busy) / sum(sizes) if sum(sizes) else 0.0
+		return per_day, total
+
+	any_days, any_total = fractions(union)
+	all_days, all_total = fractions(intersection)
+	cal_fractions = {cal_id: fractions(bits) for cal_id, bits in by_calendar.items()}
+
+	return {
+		"slot_minutes": slot_minutes,
+		"days": [{
+			"date": arrow.get(day['bt']).format("YYYY-MM-DD"),
+			"begin": day['bt'],
+			"end": day['et'],
+			"any": any_days[i],
+			"all": all_days[i],
+			"calendars": {cal_id: f[0][i] for cal_id, f in cal_fractions.items()}
+			} for i, (day, window) in enumerate(windows)],
+		"total": {
+			"any": any_total,
+			"all": all_total,
+			"calendars": {cal_id: f[1] for cal_id, f in cal_fractions.items()}
+			}
+		}
+
+
+#############################
+#
+#  Helper Functions
+#
+#############################
+
+def make_grid(iso_begin, iso_end, slot_minutes):
+	"""
+	Returns a dict describing the slots that cut up the time from iso_begin to
+	iso_end: the timestamp of the first slot, the length of a slot in seconds,
+	the number of slots, and the bitset with every slot set.
+	"""
+	origin = arrow.get(iso_begin).timestamp
+	slot   = slot_minutes * 60
+	size   = -(-(arrow.get(iso_end).timestamp - origin) // slot)		# Rounded up
+	return {"origin": origin, "slot": slot, "size": size, "full": (1 << size) - 1}
+
+
+def slot_range(grid, iso_begin, iso_end):
+	"""
+	Returns the (first, last) slots touched by the time from iso_begin to iso_end,
+	'last' excluded, clipped to the grid.
+	"""
+	begin = arrow.get(iso_begin).timestamp - grid['origin']
+	end   = arrow.get(iso_end).timestamp - grid['origin']
+	first = max(0, begin // grid['slot'])
+	last  = min(grid['size'], -(-end // grid['slot']))
+	return first, max(first, last)
+
+
+def rasterize(grid, iso_begin, iso_end):
+	"""Returns the bitset of the slots touched by the time from iso_begin to iso_end"""
+	first, last = slot_range(grid, iso_begin, iso_end)
+	return ((1 << (last - first)) - 1) << first
+
+
+def count_busy(bits, first, last):
+	"""Returns the number of busy slots of a bitset from slot 'first' to 'last', excluded"""
+	return bin((bits >> first) & ((1 << (last - first)) - 1)).count("1")
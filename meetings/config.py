@@ -43,6 +43,9 @@ def command_line_args():
                         help="Port for Flask built-in server (only)")
     parser.add_argument("-C", "--config", type=str,
                         help="Alternate configuration file")
+    parser.add_argument("--profile", dest="PROFILE",
+                        action="store_const", const=True,
+                        help="Profile a sample of requests (see profiling.py)")
     cli_args = parser.parse_args()
     log.debug("<- Command line args: {}".format(cli_args))
     return cli_args
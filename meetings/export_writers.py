@@ -0,0 +1,249 @@
+"""
+Writes busy and free blocks as iCalendar (.ics) or CSV. The writers are
+generators of text chunks, a few hundred lines each, so an export of any size
+can be streamed to a Flask response or a file in constant memory.
+
+The busy blocks are our instance dicts, as returned by
+list_instances_btwn_times_in_dates() or streamed by /api/busytimes. The free
+blocks are the parts of the time range of each date that no busy block covers.
+
+This module can also be run from the command line, to export busy times saved
+from /api/busytimes (as NDJSON or a JSON array) without going back to Google:
+
+	python3 export_writers.py busytimes.ndjson --format ics --output busy.ics
+	python3 export_writers.py busytimes.ndjson --kind free --format csv \\
+		--begin-date 11/11/2017 --end-date 11/14/2017 --begin-time 9am --end-time 5pm
+
+Main Functions:
+free_blocks					: yields the free blocks left by busy blocks in a time range
+iter_csv					: yields CSV text chunks of blocks
+iter_ics					: yields iCalendar text chunks of blocks, as VEVENTs or a VFREEBUSY
+write						: writes text chunks to a file
+
+Helper Functions:
+ics_time
+ics_text
+fold
+read_instances
+command_line_args
+main
+"""
+
+import argparse
+import csv
+import io
+import itertools
+import json
+import sys
+
+import arrow
+from dateutil import tz
+
+from from_gcal import list_availabilities_btwn_dates
+
+CHUNK_LINES = 500			# Lines of output per chunk
+FORMATS     = ("ics", "freebusy", "csv")
+EXTENSIONS  = {"ics": "ics", "freebusy": "ifb", "csv": "csv"}			# File extension of each format
+MIMETYPES   = {"ics": "text/calendar", "freebusy": "text/calendar", "csv": "text/csv"}
+KINDS       = ("busy", "free")
+PRODID      = "-//proj7-Gcal//Meeting Busy Times//EN"
+
+
+#############################
+#
+#  Main Functions
+#
+#############################
+
+def free_blocks(instances, begin_date, end_date, begin_time, end_time):
+	"""
+	Yields the free blocks, as dicts with 'begin_datetime' and 'end_datetime', left in
+	the time range of each date of the date range once the busy instances are taken out.
+	The instances need not be sorted, but all of them are held while sorting. As in
+	really_between_times(), the same begin and end time means the whole day.
+
+	Args:
+		instances:	iterable, of our instance dicts
+		begin_date:	str, an isoformatted time containing the start date and tz
+		end_date:	str, an isoformatted time containing the end date and tz
+		begin_time:	str, an isoformatted time containing the start of the time range
+		end_time:	str, an isoformatted time containing the end of the time range
+	"""
+	busy = sorted((arrow.get(i['begin_datetime']), arrow.get(i['end_datetime'])) for i in instances)
+	first = 0	# The first busy block that may still overlap the current or a later day
+	for day in list_availabilities_btwn_dates(begin_date, end_date, begin_time, end_time):
+		cursor = arrow.get(day['bt'])
+		day_end = arrow.get(day['et'])
+		if day_end == cursor:
+			day_end = cursor.shift(days=+1)
+		while first < len(busy) and busy[first][1] <= cursor:
+			first += 1
+		for busy_begin, busy_end in busy[first:]:
+			if busy_begin >= day_end:
+				break
+			if busy_begin > cursor:
+				yield {"begin_datetime": cursor.isoformat(), "end_datetime": busy_begin.isoformat()}
+			cursor = max(cursor, busy_end)
+		if cursor < day_end:
+			yield {"begin_datetime": cursor.isoformat(), "end_datetime": day_end.isoformat()}
+
+
+def iter_csv(blocks, kind="busy"):
+	"""
+	Yields CSV text chunks, with a header and a row for each block giving its kind,
+	summary, begin and end, and the calendars it came from (separated by spaces).
+	"""
+	buffer = io.StringIO()
+	writer = csv.writer(buffer)
+	writer.writerow(["kind", "summary", "begin", "end", "calendars"])
+	lines = 1
+	for block in blocks:
+		writer.writerow([kind, block.get('summary', ""), block['begin_datetime'], block['end_datetime'],
+						 " ".join(block.get('cal_ids') or [])])
+		lines += 1
+		if lines >= CHUNK_LINES:
+			yield buffer.getvalue()
+			buffer.seek(0)
+			buffer.truncate()
+			lines = 0
+	yield buffer.getvalue()
+
+
+def iter_ics(blocks, kind="busy", freebusy=False):
+	"""
+	Yields iCalendar text chunks of a calendar holding the blocks, either as one VEVENT
+	per block (opaque if busy, transparent if free), or when freebusy is True, as a
+	single VFREEBUSY with one FREEBUSY period per block.
+	"""
+	stamp = ics_time(arrow.utcnow())
+	lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:" + PRODID, "CALSCALE:GREGORIAN"]
+	if freebusy:
+		lines += ["BEGIN:VFREEBUSY", "UID:freebusy-{}@proj7-gcal".format(stamp), "DTSTAMP:" + stamp]
+	fbtype = "BUSY" if kind == "busy" else "FREE"
+
+	for block in blocks:
+		begin = ics_time(block['begin_datetime'])
+		end   = ics_time(block['end_datetime'])
+		if freebusy:
+			lines.append("FREEBUSY;FBTYPE={}:{}/{}".format(fbtype, begin, end))
+		else:
+			lines += [
+				"BEGIN:VEVENT",
+				"UID:{}-{}@proj7-gcal".format(block.get('event_id', kind), begin),
+				"DTSTAMP:" + stamp,
+				"DTSTART:" + begin,
+				"DTEND:" + end,
+				fold("SUMMARY:" + ics_text(block.get('summary', kind.capitalize()))),
+				"TRANSP:" + ("OPAQUE" if kind == "busy" else "TRANSPARENT"),
+				"END:VEVENT"
+				]
+		if len(lines) >= CHUNK_LINES:
+			yield "\r\n".join(lines) + "\r\n"
+			lines = []
+
+	if freebusy:
+		lines.append("END:VFREEBUSY")
+	lines.append("END:VCALENDAR")
+	yield "\r\n".join(lines) + "\r\n"
+
+
+def write(chunks, out):
+	"""Writes text chunks to an open file, one at a time"""
+	for chunk in chunks:
+		out.write(chunk)
+
+
+#############################
+#
+#  Helper Functions
+#
+#############################
+
+def ics_time(time):
+	"""Formats an isoformatted time (or arrow) as an iCalendar UTC date-time"""
+	return arrow.get(time).to('utc').format("YYYYMMDDTHHmmss") + "Z"
+
+
+def ics_text(text):
+	"""Escapes text for an iCalendar property value"""
+	return (text.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,")
+			.replace("\r\n", "\\n").replace("\n", "\\n"))
+
+
+def fold(line, limit=75):
+	"""Folds an iCalendar content line into lines of at most 'limit' octets"""
+	encoded = line.encode("utf-8")
+	if len(encoded) <= limit:
+		return line
+	parts = []
+	while encoded:
+		size = min(len(encoded), limit if not parts else limit - 1)
+		# Don't split a multi-byte character
+		while size < len(encoded) and (encoded[size] & 0xC0) == 0x80:
+			size -= 1
+		parts.append(encoded[:size].decode("utf-8"))
+		encoded = encoded[size:]
+	return "\r\n ".join(parts)
+
+
+def read_instances(infile):
+	"""
+	Yields the instances saved in a file from /api/busytimes, either NDJSON (read
+	one line at a time) or a JSON array. Error objects in the stream are skipped.
+	"""
+	first = infile.readline()
+	if first.lstrip().startswith("["):
+		instances = json.loads(first + infile.read())
+	else:
+		instances = (json.loads(line) for line in itertools.chain([first], infile) if line.strip())
+	for instance in instances:
+		if "error" not in instance:
+			yield instance
+
+
+def command_line_args(argv=None):
+	"""Returns namespace with settings from command line"""
+	parser = argparse.ArgumentParser(description="Export busy or free times saved from /api/busytimes")
+	parser.add_argument("input", help="NDJSON or JSON file saved from /api/busytimes, or - for stdin")
+	parser.add_argument("-f", "--format", choices=FORMATS, default="ics",
+						help="ics (VEVENTs), freebusy (VFREEBUSY) or csv")
+	parser.add_argument("-k", "--kind", choices=KINDS, default="busy",
+						help="Export the busy blocks, or the free blocks between them")
+	parser.add_argument("-o", "--output", help="Output file (default: stdout)")
+	parser.add_argument("--begin-date", help="First date, as 12/31/2001 (free blocks only)")
+	parser.add_argument("--end-date", help="Last date, as 12/31/2001 (free blocks only)")
+	parser.add_argument("--begin-time", help="Start of the time range, as 13:30 or 1:30pm (free blocks only)")
+	parser.add_argument("--end-time", help="End of the time range, as 13:30 or 1:30pm (free blocks only)")
+	args = parser.parse_args(argv)
+	if args.kind == "free" and not (args.begin_date and args.end_date and args.begin_time and args.end_time):
+		parser.error("free blocks need --begin-date, --end-date, --begin-time and --end-time")
+	return args
+
+
+def main(argv=None):
+	args = command_line_args(argv)
+	infile = sys.stdin if args.input == "-" else open(args.input)
+	blocks = read_instances(infile)
+	if args.kind == "free":
+		time_formats = ["ha", "h:mma", "h:mm a", "H:mm"]
+		blocks = free_blocks(blocks,
+							 arrow.get(args.begin_date, "MM/DD/YYYY").replace(tzinfo=tz.tzlocal()).isoformat(),
+							 arrow.get(args.end_date, "MM/DD/YYYY").replace(tzinfo=tz.tzlocal()).isoformat(),
+							 arrow.get(args.begin_time, time_formats).isoformat(),
+							 arrow.get(args.end_time, time_formats).isoformat())
+	if args.format == "csv":
+		chunks = iter_csv(blocks, args.kind)
+	else:
+		chunks = iter_ics(blocks, args.kind, freebusy=(args.format == "freebusy"))
+	out = sys.stdout if not args.output else open(args.output, "w", newline="")
+	try:
+		write(chunks, out)
+	finally:
+		if out is not sys.stdout:
+			out.close()
+		if infile is not sys.stdin:
+			infile.close()
+
+
+if __name__ == "__main__":
+	main()
@@ -4,42 +4,152 @@ from flask import request
 from flask import url_for
 import uuid
 
+import collections
 import json
 import logging
+import threading
+import time
+import types
 
 # Date/time and timezone handling 
 import arrow # Replacement for datetime, based on moment.js
 from dateutil import tz  # For interpreting local times
 
-# OAuth2  - Google library implementation for convenience
-from oauth2client import client
-import httplib2   # used in oauth2 flow
-
-# Google API for services 
-from apiclient import discovery
+# OAuth2 (oauth2client, httplib2) and the Google API for services (apiclient)
+# are slow to import, so they are only loaded when first needed. See google().
 
 # Functions to help get and process information from Google Calendars
-from from_gcal import list_calendars, list_instances_btwn_times_in_dates
+import from_gcal
+from from_gcal import list_calendars, iter_instances_btwn_times_in_dates
+
+# Utilization summaries of busy times
+from busy_bitmap import utilization, SLOT_MINUTES
+
+# Exports of busy and free times as iCalendar or CSV
+import export_writers
+
+# Opt-in profiling of requests
+import profiling
+
+# Rate limiting and retrying of the calls made to Google, and
+# coalescing of identical concurrent fetches
+import gcal_scheduler
+import single_flight
 
 
 ###
 # Globals
 ###
 import config
-if __name__ == "__main__":
-	CONFIG = config.configuration()
-else:
-	CONFIG = config.configuration(proxied=True)
 
+# The app is configured by create_app(), not when this module is imported.
+# If nothing has called it, the first request does (see configured_wsgi_app)
 app = flask.Flask(__name__)
-app.debug=CONFIG.DEBUG
-app.logger.setLevel(logging.DEBUG)
-app.secret_key=CONFIG.SECRET_KEY
+CONFIG = None
+CLIENT_SECRET_FILE = None  ## You'll need this, from GOOGLE_KEY_FILE
 
 SCOPES = 'https://www.googleapis.com/auth/calendar.readonly'
-CLIENT_SECRET_FILE = CONFIG.GOOGLE_KEY_FILE  ## You'll need this
 APPLICATION_NAME = 'MeetMe class project'
 
+GOOGLE = None           # Google client modules, once imported by google()
+CALENDAR_API = None     # Calendar API discovery document, once fetched by calendar_api()
+DISCOVERY_TIMEOUT = 10  # Seconds to wait for Google when fetching the discovery document
+_init_lock = threading.RLock()
+_calendar_api_lock = threading.Lock()
+
+DISPLAY_CACHE_SIZE = 32         # Queries whose busy times are kept to page through them
+DISPLAY_CACHE_AGE  = 2 * 60     # Seconds the busy times of a query are kept
+_display_cache = collections.OrderedDict()   # Maps display_key() to (time fetched, busy times)
+_display_lock  = threading.Lock()
+
+
+def create_app(proxied=True, preload=False, configuration=None):
+	"""
+	Reads the configuration, configures the app and the modules it uses, and
+	returns the app. Only the first call does any work, so this can be called
+	once in the gunicorn master and the workers will fork with the app ready:
+		gunicorn --preload 'flask_main:create_app(preload=True)'
+	Running 'gunicorn flask_main:app' also works, as the first request then
+	calls create_app().
+
+	When proxied = True, the command line is not read (see config.configuration).
+	With preload = True, the Google client modules are also imported and the
+	Calendar API description fetched now, rather than on the first request that
+	needs them. A configuration namespace can be given instead of reading one.
+	"""
+	global CONFIG, CLIENT_SECRET_FILE
+	with _init_lock:
+		if CONFIG is None:
+			configuration = configuration or config.configuration(proxied=proxied)
+			app.debug=configuration.DEBUG
+			app.logger.setLevel(logging.DEBUG)
+			app.secret_key=configuration.SECRET_KEY
+			CLIENT_SECRET_FILE = configuration.GOOGLE_KEY_FILE
+
+			gcal_scheduler.configure(configuration)
+			from_gcal.configure(configuration)
+			single_flight.configure(configuration)
+			profiling.configure(app, configuration)
+			# Only set once everything is configured, as configured_wsgi_app() checks it without the lock
+			CONFIG = configuration
+	if preload:
+		google()
+		try:
+			calendar_api()
+		except Exception as err:
+			# Each worker will try again on its first request
+			app.logger.warning("Could not preload the Calendar API description: {}".format(err))
+	return app
+
+
+def configured_wsgi_app(environ, start_response, wsgi_app=app.wsgi_app):
+	"""
+	Configures the app on its first request if create_app() has not been called,
+	as when run with 'gunicorn flask_main:app'. This has to happen before Flask
+	opens the session, which needs the secret key, so it can't be a request hook.
+	"""
+	if CONFIG is None:
+		create_app()
+	return wsgi_app(environ, start_response)
+
+app.wsgi_app = configured_wsgi_app
+
+
+def google():
+	"""
+	Returns a namespace with the Google client modules: 'client' from oauth2client,
+	'httplib2', and 'discovery' from apiclient. They are imported on the first call.
+	"""
+	global GOOGLE
+	if GOOGLE is None:
+		with _init_lock:
+			if GOOGLE is None:
+				from oauth2client import client
+				import httplib2
+				from apiclient import discovery
+				GOOGLE = types.SimpleNamespace(client=client, httplib2=httplib2, discovery=discovery)
+	return GOOGLE
+
+
+def calendar_api():
+	"""
+	Returns the discovery document of the Google Calendar API, which describes
+	the API to apiclient. It is fetched from Google once per process, instead of
+	once for every service object we build. The fetch has its own lock, so that
+	it doesn't hold up google() or create_app() in other threads.
+	"""
+	global CALENDAR_API
+	if CALENDAR_API is None:
+		g = google()
+		with _calendar_api_lock:
+			if CALENDAR_API is None:
+				url = g.discovery.DISCOVERY_URI.format(api='calendar', apiVersion='v3')
+				resp, content = g.httplib2.Http(timeout=DISCOVERY_TIMEOUT).request(url)
+				if resp.status >= 400:
+					raise RuntimeError("Could not get Calendar API description ({}) from {}".format(resp.status, url))
+				CALENDAR_API = content.decode('utf-8') if isinstance(content, bytes) else content
+	return CALENDAR_API
+
 #############################
 #
 #  Views
@@ -61,7 +171,10 @@ def render_display():
 	Gets all the information needed to display on the page. On the first submission,
 	it gets the calenders from Google, authorizing if needed. It then renders the page.
 	On second submission, when the user has checked the calendars to use, it gets the
-	correct event instances, then renders the page.
+	correct event instances, then renders the page. Only one page of PAGE_SIZE busy
+	times (set by the 'page' argument) is formatted and rendered, and the page is
+	streamed to the browser as it is rendered, with the busy times fetched after the
+	head of the page is sent (see BusyPage).
 	"""
 	app.logger.debug("Getting Calendars. Checking Google Calendar credentials")
 	credentials = valid_credentials()
@@ -71,22 +184,230 @@ def render_display():
 		app.logger.debug("Have Google Calendar credentials")
 		gcal_service = get_gcal_service(credentials)
 		app.logger.debug("Returned from get_gcal_service. Getting Calendars")
-		flask.session['calendars'] = list_calendars(gcal_service)
+		flask.session['calendars'] = list_calendars(gcal_service, user_key())
 	
+	page_size = getattr(CONFIG, 'PAGE_SIZE', 50)
+	page = max(1, request.args.get('page', 1, type=int))
+	busytimes = None
 	if not flask.session['selected_cal']:
 		app.logger.debug("No calendars already selected")
-		flask.session['busytimes'] = []
 		pass
 		# End of first submit
 	else:
 		# In the second submit, if user has selected calendars
-		app.logger.debug("Getting busy event instances from these selected calendars: {}".format(flask.session['selected_cal']))
-		flask.session['busytimes'] = list_instances_btwn_times_in_dates(gcal_service, flask.session['selected_cal'], 
-																		flask.session['begin_date'], flask.session['end_date'],
-																		flask.session['begin_time'], flask.session['end_time'])
+		busytimes = BusyPage(display_key(), lambda: iter_busytimes(gcal_service, credentials),
+							 page, page_size)
 		# End of second submit
 
-	return render_template('index.html')
+	return stream_template('index.html', busytimes=busytimes)
+
+
+@app.route("/utilization")
+def render_utilization():
+	"""
+	Returns, as JSON, the fraction of the time range that is busy on each date of the
+	date range, for each selected calendar and for all of them together. The 'slot'
+	argument sets the resolution in minutes (5, 15 or 30).
+	"""
+	app.logger.debug("Getting utilization. Checking Google Calendar credentials")
+	credentials = valid_credentials()
+	if not credentials:
+		return flask.redirect(flask.url_for("authorize"))
+
+	slot_minutes = request.args.get('slot', getattr(CONFIG, 'SLOT_MINUTES', 15), type=int)
+	if slot_minutes not in SLOT_MINUTES:
+		return flask.jsonify(error="slot must be one of {}".format(SLOT_MINUTES)), 400
+
+	busytimes = []
+	if flask.session.get('selected_cal'):
+		busytimes = iter_busytimes(get_gcal_service(credentials), credentials)
+	return flask.jsonify(utilization(busytimes, flask.session['begin_date'], flask.session['end_date'],
+									 flask.session['begin_time'], flask.session['end_time'], slot_minutes,
+									 flask.session.get('selected_cal')))
+
+
+@app.route("/api/busytimes")
+def api_busytimes():
+	"""
+	Streams the busy event instances of the given calendars as they are found, one JSON
+	object per line (or as a JSON array with format=json), so that long date ranges
+	start returning at once and are never held in memory or in the session.
+
+	Arguments:
+		calendar:	a calendar ID, repeated for each calendar
+		begin_date, end_date:	dates as 12/31/2001, default to the session's date range
+		begin_time, end_time:	times as 13:30 or 1:30pm, default to the session's time range
+		format:		'ndjson' (default) or 'json'
+	"""
+	app.logger.debug("API busytimes. Checking Google Calendar credentials")
+	credentials = valid_credentials()
+	if not credentials:
+		return flask.jsonify(error="Not authorized with Google Calendar, log in at {}".format(
+			url_for('authorize', _external=True))), 401
+
+	selected_cal = request.args.getlist('calendar')
+	out_format = request.args.get('format', 'ndjson')
+	if not selected_cal or out_format not in ('ndjson', 'json'):
+		return flask.jsonify(error="Expected one or more 'calendar' and a format of 'ndjson' or 'json'"), 400
+	try:
+		begin_date = interpret_arg_date('begin_date')
+		end_date   = interpret_arg_date('end_date')
+		begin_time = interpret_arg_time('begin_time')
+		end_time   = interpret_arg_time('end_time')
+	except KeyError as err:
+		return flask.jsonify(error="Missing parameter '{}', and no default in the session".format(err.args[0])), 400
+	except Exception:
+		return flask.jsonify(error="Dates must be like 12/31/2001 and times like 13:30 or 1:30pm"), 400
+
+	instances = iter_instances_btwn_times_in_dates(get_gcal_service(credentials), selected_cal,
+												   begin_date, end_date, begin_time, end_time,
+												   user_key(), http_factory(credentials), calendar_roles())
+
+	def generate():
+		separator = ""
+		if out_format == 'json':
+			yield "["
+		try:
+			for instance in instances:
+				if out_format == 'json':
+					yield separator + json.dumps(instance)
+					separator = ",\n"
+				else:
+					yield json.dumps(instance) + "\n"
+		except Exception as err:
+			# The status is already sent, so the error can only be reported in the stream
+			app.logger.exception("Failed while streaming busy times")
+			error = json.dumps({"error": str(err)})
+			yield separator + error if out_format == 'json' else error + "\n"
+		if out_format == 'json':
+			yield "]\n"
+
+	mimetype = "application/json" if out_format == 'json' else "application/x-ndjson"
+	return flask.Response(flask.stream_with_context(generate()), mimetype=mimetype)
+
+
+@app.route("/export/busytimes.<fmt>")
+def export_busytimes(fmt):
+	"""
+	Streams the busy times of the selected calendars, in the date and time range
+	of the session, as an iCalendar (fmt 'ics' with VEVENTs, 'freebusy' with a VFREEBUSY)
+	or CSV ('csv') download. With kind=free, exports the free blocks between them.
+	The formats are those of the export_writers command line.
+	"""
+	app.logger.debug("Exporting busy times. Checking Google Calendar credentials")
+	credentials = valid_credentials()
+	if not credentials:
+		return flask.redirect(flask.url_for("authorize"))
+
+	kind = request.args.get('kind', 'busy')
+	if fmt not in export_writers.FORMATS or kind not in export_writers.KINDS or not flask.session.get('selected_cal'):
+		flask.abort(404)
+
+	blocks = iter_busytimes(get_gcal_service(credentials), credentials)
+	if kind == 'free':
+		blocks = export_writers.free_blocks(blocks, flask.session['begin_date'], flask.session['end_date'],
+											flask.session['begin_time'], flask.session['end_time'])
+	if fmt == 'csv':
+		chunks = export_writers.iter_csv(blocks, kind)
+	else:
+		chunks = export_writers.iter_ics(blocks, kind, freebusy=(fmt == 'freebusy'))
+
+	response = flask.Response(flask.stream_with_context(chunks), mimetype=export_writers.MIMETYPES[fmt])
+	response.headers['Content-Disposition'] = 'attachment; filename="{}times.{}"'.format(
+		kind, export_writers.EXTENSIONS[fmt])
+	return response
+
+
+def iter_busytimes(gcal_service, credentials):
+	"""
+	Yields the busy event instances of the selected calendars, within the time
+	range of each date of the date range stored in the session.
+	"""
+	app.logger.debug("Getting busy event instances from these selected calendars: {}".format(flask.session['selected_cal']))
+	return iter_instances_btwn_times_in_dates(gcal_service, flask.session['selected_cal'],
+											  flask.session['begin_date'], flask.session['end_date'],
+											  flask.session['begin_time'], flask.session['end_time'],
+											  user_key(), http_factory(credentials), calendar_roles())
+
+
+class BusyPage:
+	"""
+	One page of the busy times of the selected calendars, for the template. The busy
+	times are only fetched when the template loops over the rows, once the head of the
+	page has been sent. All of them are then kept for DISPLAY_CACHE_AGE seconds, so
+	that the other pages of the same query are slices of that result, not new fetches.
+	'total' and 'pages' are known once the rows have been looped over. As the status of
+	the page is sent by then, a failed fetch is logged and kept in 'error' for the
+	template to show after the rows, and the busy times fetched so far are not kept.
+	"""
+
+	def __init__(self, key, fetch, page, page_size):
+		self.key       = key
+		self.fetch     = fetch		# Returns an iterator over all the busy times
+		self.page      = page
+		self.page_size = page_size
+		self.total     = None
+		self.error     = None
+
+	def __iter__(self):
+		first = (self.page - 1) * self.page_size
+		instances = cached_busytimes(self.key)
+		if instances is None:
+			instances = []
+			try:
+				for instance in self.fetch():
+					if first <= len(instances) < first + self.page_size:
+						yield format_instance(instance)
+					instances.append(instance)
+			except Exception as err:
+				app.logger.exception("Failed while fetching busy times for the page")
+				self.error = str(err) or err.__class__.__name__
+			else:
+				cache_busytimes(self.key, instances)
+		else:
+			for instance in instances[first:first + self.page_size]:
+				yield format_instance(instance)
+		self.total = len(instances)
+
+	@property
+	def pages(self):
+		return -(-self.total // self.page_size)
+
+
+def display_key():
+	"""Identifies the busy times query of the session, for the display cache"""
+	return (user_key(), tuple(flask.session['selected_cal']),
+			flask.session['begin_date'], flask.session['end_date'],
+			flask.session['begin_time'], flask.session['end_time'])
+
+
+def cached_busytimes(key):
+	"""The busy times kept for the query 'key', or None if there are none or they are too old"""
+	with _display_lock:
+		entry = _display_cache.get(key)
+		if entry is None or time.time() - entry[0] > DISPLAY_CACHE_AGE:
+			return None
+		return entry[1]
+
+
+def cache_busytimes(key, instances):
+	"""Keeps the busy times of the query 'key', forgetting the oldest queries beyond DISPLAY_CACHE_SIZE"""
+	with _display_lock:
+		_display_cache[key] = (time.time(), instances)
+		_display_cache.move_to_end(key)
+		while len(_display_cache) > DISPLAY_CACHE_SIZE:
+			_display_cache.popitem(last=False)
+
+
+def stream_template(template_name, **context):
+	"""
+	Renders a template a few parts at a time, sending each to the browser as soon
+	as it is rendered instead of building the whole page first.
+	"""
+	app.update_template_context(context)
+	stream = app.jinja_env.get_template(template_name).stream(context)
+	stream.enable_buffering(5)
+	return flask.Response(flask.stream_with_context(stream))
 
 
 #####
@@ -172,7 +493,7 @@ def valid_credentials():
 	if 'credentials' not in flask.session:
 		return None
 
-	credentials = client.OAuth2Credentials.from_json(flask.session['credentials'])
+	credentials = google().client.OAuth2Credentials.from_json(flask.session['credentials'])
 
 	if (credentials.invalid or credentials.access_token_expired):
 		return None
@@ -180,6 +501,37 @@ def valid_credentials():
 	return credentials
 
 
+def user_key():
+	"""
+	Returns an opaque key identifying the user of this session, which
+	is used to share out our Google quota fairly between users, and to
+	only coalesce fetches made with the same credentials.
+	"""
+	if 'user_key' not in flask.session:
+		flask.session['user_key'] = uuid.uuid4().hex
+	return flask.session['user_key']
+
+
+def calendar_roles():
+	"""
+	Returns the user's access role to each of their calendars, as listed by
+	list_calendars(), so that fetches from a calendar can be shared with the
+	other users who have the same role to it (see from_gcal.share_scope).
+	"""
+	return {cal['id']: cal['access_role'] for cal in flask.session.get('calendars', [])
+			if cal.get('access_role')}
+
+
+def http_factory(credentials):
+	"""
+	Returns a function making a new httplib2.Http authorized with the credentials.
+	An Http can't be shared between threads, so each thread fetching from Google
+	needs its own.
+	"""
+	httplib2 = google().httplib2
+	return lambda: credentials.authorize(httplib2.Http())
+
+
 def get_gcal_service(credentials):
 	"""
 	We need a Google calendar 'service' object to obtain
@@ -191,8 +543,8 @@ def get_gcal_service(credentials):
 	Then the second call will succeed without additional authorization.
 	"""
 	app.logger.debug("Entering get_gcal_service")
-	http_auth = credentials.authorize(httplib2.Http())
-	service = discovery.build('calendar', 'v3', http=http_auth)
+	http_auth = http_factory(credentials)()
+	service = google().discovery.build_from_document(calendar_api(), http=http_auth)
 	app.logger.debug("Returning service")
 	return service
 
@@ -222,7 +574,7 @@ def oauth2callback():
 	and so on.
 	"""
 	app.logger.debug("Entering oauth2callback")
-	flow =  client.flow_from_clientsecrets(
+	flow =  google().client.flow_from_clientsecrets(
 		CLIENT_SECRET_FILE,
 		scope= SCOPES,
 		redirect_uri=flask.url_for('oauth2callback', _external=True))
@@ -281,12 +633,13 @@ def init_session_values():
 	flask.session['selected_cal'] = []
 
 
-def interpret_time( text ):
+def interpret_time( text, flash=True ):
 	"""
 	Read time in a human-compatible format and
 	interpret as ISO format with local timezone.
 	May throw exception if time can't be interpreted. In that
-	case it will also flash a message explaining accepted formats.
+	case it will also flash a message explaining accepted formats,
+	unless flash = False.
 	"""
 	app.logger.debug("Decoding time '{}'".format(text))
 	time_formats = ["ha", "h:mma",  "h:mm a", "H:mm"]
@@ -296,8 +649,9 @@ def interpret_time( text ):
 		app.logger.debug("Succeeded interpreting time")
 	except:
 		app.logger.debug("Failed to interpret time")
-		flask.flash("Time '{}' didn't match accepted formats 13:30 or 1:30pm"
-			  .format(text))
+		if flash:
+			flask.flash("Time '{}' didn't match accepted formats 13:30 or 1:30pm"
+				  .format(text))
 		raise
 	return as_arrow.isoformat()
 	#HACK #Workaround
@@ -311,20 +665,39 @@ def interpret_time( text ):
 	# on raspberry Pi --- failure is likely due to 32-bit integers on that platform)
 
 
-def interpret_date( text ):
+def interpret_date( text, flash=True ):
 	"""
 	Convert text of date to ISO format used internally,
-	with the local time zone.
+	with the local time zone. Flashes a message explaining
+	the expected format on failure, unless flash = False.
 	"""
 	try:
 	  as_arrow = arrow.get(text, "MM/DD/YYYY").replace(
 		  tzinfo=tz.tzlocal())
 	except:
-		flask.flash("Date '{}' didn't fit expected format 12/31/2001")
+		if flash:
+			flask.flash("Date '{}' didn't fit expected format 12/31/2001")
 		raise
 	return as_arrow.isoformat()
 
 
+def interpret_arg_date(name):
+	"""
+	Date request argument 'name' in ISO format, or the session's value if not given.
+	Nothing is flashed, as API callers don't see the session's messages.
+	"""
+	if name in request.args:
+		return interpret_date(request.args[name], flash=False)
+	return flask.session[name]
+
+
+def interpret_arg_time(name):
+	"""Time request argument 'name' in ISO format, or the session's value if not given, without flashing"""
+	if name in request.args:
+		return interpret_time(request.args[name], flash=False)
+	return flask.session[name]
+
+
 def next_day(isotext):
 	"""
 	ISO date + 1 day (used in query to Google calendar)
@@ -340,6 +713,20 @@ def next_day(isotext):
 #################
 
 
+def format_instance( instance ):
+	"""
+	Adds the begin and end date-times of an instance, formatted for display,
+	so that each is only parsed once rather than by filters in the template.
+	"""
+	for key in ('begin', 'end'):
+		try:
+			normal = arrow.get( instance[key + '_datetime'] )
+			instance[key + '_display'] = normal.format("ddd MM/DD/YYYY HH:mm")
+		except:
+			instance[key + '_display'] = "(bad date)"
+	return instance
+
+
 @app.template_filter( 'fmtdate' )
 def format_arrow_date( date ):
 	try: 
@@ -363,6 +750,8 @@ def format_arrow_time( time ):
 if __name__ == "__main__":
   # App is created above so that it will
   # exist whether this is 'main' or not
-  # (e.g., if we are running under green unicorn)
+  # (e.g., if we are running under green unicorn,
+  # which calls create_app itself)
+  create_app(proxied=False)
   app.run(port=CONFIG.PORT,host="0.0.0.0")
 	
@@ -1,14 +1,25 @@
 """
 Module that requests information from Google Calendars. All the main functions require a valid google calendar service.
 Get the user credentials, build the service, and then pass the service into the functions along with any other required
-parameters.
+parameters. Every call to Google goes through gcal_scheduler, which rate limits and retries it,
+and identical concurrent fetches are coalesced through single_flight.
 
 Main Functions:
+configure							: sets the chunking of long date ranges from a config namespace
 list_calendars						: lists all of a user calendars
 list_instances_between_datetimes	: lists all event instances from selected calendars that are not transparent,
 									  and between a start and end time of EACH date within a date range
+iter_instances_btwn_times_in_dates	: same, but yields the instances one by one as they are found
+list_events_in_chunks				: lists the events of selected calendars over a long date-time range, in
+									  parallel chunks, merged in time order
 
 Helper Functions:
+fetch
+share_scope
+list_events
+split_time_range
+event_start_key
+event_dedupe_key
 cal_sort_key
 double_check_date_restriction
 reorg_instance
@@ -17,25 +28,52 @@ merge_date_time
 list_availabilities_btwn_dates
 """
 
+import heapq
+import threading
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+
 import arrow
 from dateutil import tz
 
+import single_flight
+from gcal_scheduler import execute
+
+#
+# Long date ranges are split into chunks of CHUNK_DAYS days, which are
+# fetched by up to FETCH_WORKERS threads. See configure().
+#
+CHUNK_DAYS    = 7
+FETCH_WORKERS = 4
+
 #############################
 #
 #  Main Functions
 #
 #############################
 
-def list_calendars(service):
+def configure(config):
+	"""
+	Sets the chunk size (GCAL_CHUNK_DAYS) and number of parallel fetches
+	(GCAL_FETCH_WORKERS) used for long date ranges from a configuration
+	namespace, as returned by config.configuration().
+	"""
+	global CHUNK_DAYS, FETCH_WORKERS
+	CHUNK_DAYS    = int(getattr(config, "GCAL_CHUNK_DAYS", CHUNK_DAYS))
+	FETCH_WORKERS = int(getattr(config, "GCAL_FETCH_WORKERS", FETCH_WORKERS))
+
+
+def list_calendars(service, user=None):
 	"""
 	Given a google 'service' object, return a list of
 	calendars.  Each calendar is represented by a dict.
 	The returned list is sorted to have
 	the primary calendar first, and selected (that is, displayed in
 	Google Calendars web app) calendars before unselected calendars.
+	'user' identifies whose quota the calls count against.
 	"""
 	print("Listing calendars from Google Calendar")  
-	calendar_list = service.calendarList().list().execute()["items"]
+	calendar_list = fetch(("calendarList",), service.calendarList().list(), user)["items"]
 	result = []
 	for cal in calendar_list:
 		# Optional binary attributes with False as default
@@ -48,12 +86,14 @@ def list_calendars(service):
 			"summary": cal["summary"],
 			"selected": selected,
 			"primary": primary,
+			"access_role": cal.get("accessRole"),
 			})
 	
 	return sorted(result, key=cal_sort_key)
 
 
-def list_instances_btwn_times_in_dates(service, selected_cal, begin_date, end_date, begin_time, end_time):
+def list_instances_btwn_times_in_dates(service, selected_cal, begin_date, end_date, begin_time, end_time, user=None,
+									   http_factory=None, roles=None):
 	"""
 	Given a google 'service' object and a list of calendar IDs, returns a list of 
 	event instances that fall between the given time range on each date within the 
@@ -70,61 +110,140 @@ def list_instances_btwn_times_in_dates(service, selected_cal, begin_date, end_da
 	2013-05-13T09:00:00+00:00 to 2013-05-13T18:00:00+00:00
 	2013-05-14T09:00:00+00:00 to 2013-05-14T18:00:00+00:00
 	2013-05-15T09:00:00+00:00 to 2013-05-15T18:00:00+00:00
+
+	'user' identifies whose quota the calls to Google count against. Long date ranges are
+	fetched in chunks, in parallel if an 'http_factory' (a callable returning a new authorized
+	httplib2.Http, as those can't be shared between threads) is given. 'roles' maps calendar
+	IDs to the user's access role to them (see list_calendars()), so that fetches from a
+	calendar can be shared with other users having the same role (see share_scope()).
+	"""
+	result = list(iter_instances_btwn_times_in_dates(service, selected_cal, begin_date, end_date,
+													 begin_time, end_time, user, http_factory, roles))
+	print("All busy instances found: {}".format(result))
+	return result
+
+
+def iter_instances_btwn_times_in_dates(service, selected_cal, begin_date, end_date, begin_time, end_time, user=None,
+									   http_factory=None, roles=None):
+	"""
+	Same as list_instances_btwn_times_in_dates(), but yields each instance as soon as it has
+	been fetched and found to be within the time range, instead of returning them all at once.
 	"""
-	
 	begin_datetime = merge_date_time(begin_date, begin_time)	# An isoformatted time string of the earliest date and the start time
 	end_datetime   = merge_date_time(end_date,   end_time)		# An isoformatted time string of the latest date and the end time
 	print("Getting Google Calendar events from selected calendars")
 
 	# There may be events that recur. The first loop identifies all the unique "types" of events
-	# and then the second loop finds all instances of the event, nonrecurring and recurring
+	# and then the second loop finds all instances of the event, nonrecurring and recurring.
+	# The same event may be on several of the selected calendars (invites, team calendars), so
+	# the first loop keeps only one copy of it, recording which calendars it came from
 	pre_events = []
-	for cal_id in selected_cal:
-		events = service.events().list(calendarId=cal_id, timeMin=begin_datetime, timeMax=end_datetime).execute()
-		print("Events found: {}".format(events))
-		for event in events['items']:
-			# Ignores transparent events
-			if "transparency" in event and event["transparency"] == "transparent":
-				continue
-
-			# Identifies if the event recurs
-			if "recurrence" in event:
-				recurs = True
-			else:
-				recurs = False
-
-			# Append each event to list
-			pre_events.append({
-				"event_id": event['id'],
-				"cal_id": cal_id,
-				"recurs": recurs
-				})
+	shared = {}		# Maps the event_dedupe_key() of each event to its entry in pre_events
+	# The events are listed in chunks of the date range, fetched in parallel, and merged in time order
+	for cal_id, event in list_events_in_chunks(service, selected_cal, begin_datetime, end_datetime, user, http_factory,
+											   roles):
+		# Ignores transparent events
+		if "transparency" in event and event["transparency"] == "transparent":
+			continue
+
+		# Only fetches the instances of a shared event once
+		key = event_dedupe_key(event)
+		if key in shared:
+			shared[key]['cal_ids'].append(cal_id)
+			continue
+
+		# Identifies if the event recurs
+		if "recurrence" in event:
+			recurs = True
+		else:
+			recurs = False
+
+		# Append each event to list
+		shared[key] = {
+			"event_id": event['id'],
+			"cal_id": cal_id,
+			"cal_ids": [cal_id],
+			"recurs": recurs
+			}
+		pre_events.append(shared[key])
 
 	# This is the second loop, getting all instances that Google gives us, and then eliminating those
 	# that are not really within the time range on each day
 	print("Finding event instances")
-	result = []
 	for pre_e in pre_events:
 		if pre_e['recurs']:
 			# Need to get all event instances for a recurring event, within a certain date-time range
-			instances = service.events().instances(calendarId=pre_e['cal_id'], eventId=pre_e['event_id'],
-												   timeMin=begin_datetime, timeMax=end_datetime).execute()
+			instances = fetch(("instances", pre_e['cal_id'], pre_e['event_id'], begin_datetime, end_datetime),
+							  service.events().instances(calendarId=pre_e['cal_id'], eventId=pre_e['event_id'],
+														 timeMin=begin_datetime, timeMax=end_datetime), user,
+							  scope=share_scope(pre_e['cal_id'], user, roles))
 			print("Recurring instances found: {}".format(instances))
 			for instance in instances['items']:
-				instance = reorg_instance(instance)
+				instance = reorg_instance(instance, pre_e['cal_ids'])
 				if really_between_times(instance, begin_time, end_time):
-					result.append(instance)
+					yield instance
 		else:
 			# For non-recurring events, there is only one instance
-			instance = service.events().get(calendarId=pre_e['cal_id'], eventId=pre_e['event_id']).execute()
+			instance = fetch(("event", pre_e['cal_id'], pre_e['event_id']),
+							 service.events().get(calendarId=pre_e['cal_id'], eventId=pre_e['event_id']), user,
+							 scope=share_scope(pre_e['cal_id'], user, roles))
 			print("Nonrecurring instances found: {}".format(instance))
 			if instance:
-				instance = reorg_instance(instance)
+				instance = reorg_instance(instance, pre_e['cal_ids'])
 				if really_between_times(instance, begin_time, end_time):
-					result.append(instance)
-	
-	print("All busy instances found: {}".format(result))
-	return result
+					yield instance
+
+
+def list_events_in_chunks(service, selected_cal, begin_datetime, end_datetime, user=None, http_factory=None,
+						  roles=None):
+	"""
+	Lists the events of each selected calendar that overlap a date-time range. The range is
+	split into chunks of CHUNK_DAYS days, and each chunk of each calendar is fetched separately,
+	in parallel when an http_factory is given. The chunks are then merged in order of start
+	time. An event that crosses the boundary between two chunks is found in both, and is only
+	returned once.
+
+	Args:
+		service:		a google calendar 'service' object
+		selected_cal:	list, the IDs of the calendars to list events from
+		begin_datetime:	str, an isoformatted time of the start of the range
+		end_datetime:	str, an isoformatted time of the end of the range
+		user:			hashable, identifies whose quota the calls to Google count against
+		http_factory:	callable returning a new authorized httplib2.Http, one of which is made for
+						each fetching thread. Without it, the chunks are fetched one by one
+		roles:			dict, the user's access role to each calendar, see share_scope()
+
+	Returns:
+		an iterator of (calendar ID, google event dict) tuples, in order of start time
+	"""
+	tasks = [(cal_id, chunk_begin, chunk_end)
+			 for cal_id in selected_cal
+			 for chunk_begin, chunk_end in split_time_range(begin_datetime, end_datetime, CHUNK_DAYS)]
+
+	local = threading.local()
+	def fetch_chunk(task):
+		cal_id, chunk_begin, chunk_end = task
+		http = None
+		if http_factory is not None:
+			if not hasattr(local, "http"):
+				local.http = http_factory()
+			http = local.http
+		events = list_events(service, cal_id, chunk_begin, chunk_end, user, http, share_scope(cal_id, user, roles))
+		return sorted(((event_start_key(event), cal_id, event) for event in events), key=itemgetter(0))
+
+	if http_factory is not None and len(tasks) > 1:
+		print("Fetching {} chunks of events with {} threads".format(len(tasks), FETCH_WORKERS))
+		with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+			chunks = list(executor.map(fetch_chunk, tasks))
+	else:
+		chunks = [fetch_chunk(task) for task in tasks]
+
+	seen = set()
+	for start, cal_id, event in heapq.merge(*chunks, key=itemgetter(0)):
+		if (cal_id, event['id']) in seen:
+			continue
+		seen.add((cal_id, event['id']))
+		yield cal_id, event
 
 
 #############################
@@ -134,6 +253,109 @@ def list_instances_btwn_times_in_dates(service, selected_cal, begin_date, end_da
 #############################
 
 
+def fetch(key, request, user, http=None, scope=None):
+	"""
+	Executes a google request, sharing its result with any identical fetch that is
+	already in flight, in this process or (if configured) in another worker.
+
+	Args:
+		key:		tuple, identifies what is fetched (e.g. calendar id and time window)
+		request:	a google API request object
+		user:		hashable, whose quota the request counts against
+		http:		an optional authorized httplib2.Http to execute the request with
+		scope:		hashable, who the result can be shared with, as returned by share_scope().
+					Defaults to only the same user
+
+	Returns:
+		the response of the request, as a dict. It may be shared, so must not be modified
+	"""
+	if scope is None:
+		scope = ("user", user)
+	return single_flight.do((scope,) + key, lambda: execute(request, user, http))
+
+
+def share_scope(cal_id, user, roles=None):
+	"""
+	Returns who a fetch from calendar 'cal_id' can be shared with. Google shows the
+	same events to everyone with the same access role to a calendar, so that is
+	everyone with the role 'roles' gives for it (the accessRole of the user's own
+	calendarList entry). Without a known role, only the same user.
+	"""
+	role = (roles or {}).get(cal_id)
+	if role:
+		return ("role", role)
+	return ("user", user)
+
+
+def list_events(service, cal_id, begin_datetime, end_datetime, user, http=None, scope=None):
+	"""
+	Returns the list of all events of a calendar that overlap a date-time range,
+	following the pages of the response. 'scope' is passed on to fetch().
+	"""
+	events = []
+	page_token = None
+	while True:
+		params = {"calendarId": cal_id, "timeMin": begin_datetime, "timeMax": end_datetime}
+		if page_token:
+			params["pageToken"] = page_token
+		page = fetch(("events", cal_id, begin_datetime, end_datetime, page_token),
+					 service.events().list(**params), user, http, scope)
+		print("Events found: {}".format(page))
+		events.extend(page['items'])
+		page_token = page.get('nextPageToken')
+		if not page_token:
+			return events
+
+
+def split_time_range(begin_datetime, end_datetime, chunk_days):
+	"""
+	Splits a date-time range into consecutive chunks of at most chunk_days days.
+
+	Args:
+		begin_datetime:	str, an isoformatted time of the start of the range
+		end_datetime:	str, an isoformatted time of the end of the range
+		chunk_days:		int, the length of a chunk in days
+
+	Returns:
+		a list of (begin, end) tuples of isoformatted times, covering the range
+	"""
+	begin = arrow.get(begin_datetime)
+	end   = arrow.get(end_datetime)
+	chunks = []
+	while begin < end:
+		chunk_end = min(begin.shift(days=+chunk_days), end)
+		chunks.append((begin.isoformat(), chunk_end.isoformat()))
+		begin = chunk_end
+	return chunks or [(begin_datetime, end_datetime)]
+
+
+def event_start_key(event):
+	"""
+	Sort key for google events by start time, as a timestamp. All day events
+	start at midnight UTC of their date.
+	"""
+	start = event.get('start', {})
+	return arrow.get(start.get('dateTime', start.get('date', 0))).timestamp
+
+
+def event_dedupe_key(event):
+	"""
+	Returns a key that is the same for copies of one event found on different calendars.
+	Copies of a shared event have the same iCalUID, but so do the modified instances of
+	a recurring event, which are told apart by their recurring event ID and original start.
+
+	Args:
+		event:	dict, a google calendar event dict
+
+	Returns:
+		a hashable tuple
+	"""
+	original_start = event.get('originalStartTime', {})
+	return (event.get('iCalUID', event['id']),
+			event.get('recurringEventId'),
+			original_start.get('dateTime', original_start.get('date')))
+
+
 def cal_sort_key( cal ):
 	"""
 	Sort key for the list of calendars:  primary calendar first,
@@ -151,13 +373,14 @@ def cal_sort_key( cal ):
 	return (primary_key, selected_key, cal["summary"])
 			
 
-def reorg_instance(instance):
+def reorg_instance(instance, cal_ids=None):
 	"""
 	Reorganizes the instance object returned from Google, for more consistency
 	and removing unnecesary information
 
 	Args:
 		instance:	dict, a google calendar dict
+		cal_ids:	list, the IDs of the selected calendars the instance is on
 
 	Returns:
 		a dict with only relevant key value pairs
@@ -181,7 +404,8 @@ def reorg_instance(instance):
 			"event_id": instance['id'],
 			"summary": instance['summary'],
 			"begin_datetime": begin_datetime,
-			"end_datetime": end_datetime
+			"end_datetime": end_datetime,
+			"cal_ids": cal_ids or []
 			}
 
 
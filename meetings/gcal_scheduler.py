@@ -0,0 +1,396 @@
+"""
+Schedules calls to the Google Calendar API. Every request built from a google
+'service' object should be executed through this module rather than by calling
+request.execute() directly, so that we stay close to our quota instead of failing
+user requests whenever Google throttles us.
+
+The scheduler combines:
+	- a global token bucket, shared by every call the process makes. It is per
+	  process, so N gunicorn workers together allow N times GCAL_GLOBAL_RATE:
+	  divide the quota by the number of workers when setting it
+	- per-user token buckets, so one busy user cannot starve the others
+	- an adaptive concurrency limit, cut when Google throttles us and slowly
+	  raised again while calls keep succeeding (additive increase,
+	  multiplicative decrease)
+	- jittered exponential backoff between retries of throttled calls
+	- a retry budget, so that retries can never add more than a fraction of
+	  extra load on top of the first attempts
+
+A userRateLimitExceeded error only slows down the bucket of the user who got
+it. The global rate and the concurrency limit are only cut on a 429 or a
+rateLimitExceeded, and at most once per COOLDOWN seconds, so that a burst of
+concurrent calls throttled together counts as a single decrease.
+
+Main Functions:
+execute								: executes a google request through the default scheduler
+configure							: replaces the default scheduler using values from a config namespace
+
+Classes:
+TokenBucket
+AdaptiveLimit
+RetryBudget
+CallScheduler
+"""
+
+import collections
+import json
+import logging
+import random
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+#
+# Defaults, which can be overridden from app.ini / credentials.ini through
+# configure(). Rates are in calls per second.
+#
+GLOBAL_RATE     = 10.0
+GLOBAL_BURST    = 20
+USER_RATE       = 5.0
+USER_BURST      = 10
+MAX_CONCURRENCY = 8
+MAX_RETRIES     = 5
+BACKOFF_BASE    = 0.5		# Seconds before the first retry (upper bound of the jitter)
+BACKOFF_CAP     = 32.0		# Longest we will ever wait between two attempts
+RETRY_RATIO     = 0.2		# Retries allowed per first attempt
+COOLDOWN        = 2.0		# Seconds after cutting the global rate before it can be cut again
+MAX_USERS       = 1024		# Number of per-user buckets kept before evicting the oldest
+
+# HTTP statuses and Google error reasons that mean "slow down"
+THROTTLE_STATUSES = (429,)
+THROTTLE_REASONS  = ("rateLimitExceeded", "userRateLimitExceeded")
+# Google error reasons that are about the quota of one user only
+USER_THROTTLE_REASONS = ("userRateLimitExceeded",)
+# HTTP statuses that are worth retrying, but are not a sign of throttling
+TRANSIENT_STATUSES = (500, 502, 503, 504)
+
+
+#############################
+#
+#  Main Functions
+#
+#############################
+
+def execute(request, user=None, http=None):
+	"""
+	Executes a google API request through the default scheduler.
+
+	Args:
+		request:	a google API request object, as returned by e.g. service.events().list()
+		user:		hashable, identifies whose quota the call counts against. None
+					only counts against the global quota
+		http:		an optional authorized httplib2.Http to execute the request with
+
+	Returns:
+		the response of the request, as a dict
+	"""
+	return SCHEDULER.execute(request, user=user, http=http)
+
+
+def configure(config):
+	"""
+	Replaces the default scheduler with one built from the GCAL_* values of a
+	configuration namespace (as returned by config.configuration()). Values
+	that are not set keep their defaults.
+	"""
+	global SCHEDULER
+
+	def setting(name, default, convert=float):
+		return convert(getattr(config, "GCAL_" + name, default))
+
+	SCHEDULER = CallScheduler(
+		global_rate=setting("GLOBAL_RATE", GLOBAL_RATE),
+		global_burst=setting("GLOBAL_BURST", GLOBAL_BURST, int),
+		user_rate=setting("USER_RATE", USER_RATE),
+		user_burst=setting("USER_BURST", USER_BURST, int),
+		max_concurrency=setting("MAX_CONCURRENCY", MAX_CONCURRENCY, int),
+		max_retries=setting("MAX_RETRIES", MAX_RETRIES, int),
+		backoff_base=setting("BACKOFF_BASE", BACKOFF_BASE),
+		backoff_cap=setting("BACKOFF_CAP", BACKOFF_CAP),
+		retry_ratio=setting("RETRY_RATIO", RETRY_RATIO),
+		cooldown=setting("COOLDOWN", COOLDOWN))
+	return SCHEDULER
+
+
+#############################
+#
+#  Classes
+#
+#############################
+
+class TokenBucket:
+	"""
+	A token bucket refilled at 'rate' tokens per second, holding at most
+	'capacity' tokens. Callers reserve a token and are told how long to wait
+	before using it, so the bucket never blocks while holding its lock.
+	"""
+
+	def __init__(self, rate, capacity, clock=time.monotonic):
+		self.max_rate = rate
+		self.rate     = rate
+		self.capacity = capacity
+		self.tokens   = capacity
+		self.clock    = clock
+		self.updated  = clock()
+		self.lock     = threading.Lock()
+
+	def reserve(self):
+		"""
+		Takes one token, going into debt if the bucket is empty.
+
+		Returns:
+			the number of seconds the caller must wait before making its call
+		"""
+		with self.lock:
+			self._refill()
+			self.tokens -= 1
+			if self.tokens >= 0:
+				return 0.0
+			return -self.tokens / self.rate
+
+	def slow_down(self, factor=0.5, floor=0.1):
+		"""Multiplicatively reduces the refill rate, down to 'floor' calls per second"""
+		with self.lock:
+			self._refill()
+			self.rate = max(floor, self.rate * factor)
+
+	def speed_up(self, step=0.1):
+		"""Additively raises the refill rate, back up to the configured rate"""
+		with self.lock:
+			self._refill()
+			self.rate = min(self.max_rate, self.rate + step)
+
+	def _refill(self):
+		now = self.clock()
+		self.tokens  = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+
+
+class AdaptiveLimit:
+	"""
+	A semaphore whose size moves between 1 and 'maximum': it is halved every
+	time Google throttles us, and grows by a fraction of a slot for every
+	successful call.
+	"""
+
+	def __init__(self, maximum):
+		self.maximum   = maximum
+		self.limit     = float(maximum)
+		self.in_flight = 0
+		self.cond      = threading.Condition()
+
+	def __enter__(self):
+		with self.cond:
+			while self.in_flight >= int(self.limit):
+				self.cond.wait()
+			self.in_flight += 1
+		return self
+
+	def __exit__(self, *exc):
+		with self.cond:
+			self.in_flight -= 1
+			self.cond.notify()
+		return False
+
+	def decrease(self):
+		with self.cond:
+			self.limit = max(1.0, self.limit / 2)
+
+	def increase(self):
+		with self.cond:
+			self.limit = min(float(self.maximum), self.limit + 1.0 / max(1.0, self.limit))
+			self.cond.notify_all()
+
+
+class RetryBudget:
+	"""
+	Every first attempt deposits 'ratio' tokens, and every retry withdraws one.
+	A small reserve of 'minimum' tokens lets a quiet process still retry.
+	"""
+
+	def __init__(self, ratio, minimum=10):
+		self.ratio   = ratio
+		self.minimum = minimum
+		self.tokens  = float(minimum)
+		self.lock    = threading.Lock()
+
+	def deposit(self):
+		with self.lock:
+			self.tokens = min(self.tokens + self.ratio, self.minimum + 100 * self.ratio)
+
+	def withdraw(self):
+		"""Returns True if a retry may be made"""
+		with self.lock:
+			if self.tokens < 1:
+				return False
+			self.tokens -= 1
+			return True
+
+
+class CallScheduler:
+	"""
+	Executes google API requests under the global and per-user token buckets,
+	the adaptive concurrency limit and the retry budget. See the module
+	docstring for the overall behaviour.
+	"""
+
+	def __init__(self, global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST,
+				 user_rate=USER_RATE, user_burst=USER_BURST,
+				 max_concurrency=MAX_CONCURRENCY, max_retries=MAX_RETRIES,
+				 backoff_base=BACKOFF_BASE, backoff_cap=BACKOFF_CAP,
+				 retry_ratio=RETRY_RATIO, cooldown=COOLDOWN, clock=time.monotonic, sleep=time.sleep):
+		self.global_bucket = TokenBucket(global_rate, global_burst, clock)
+		self.user_rate     = user_rate
+		self.user_burst    = user_burst
+		self.user_buckets  = collections.OrderedDict()
+		self.users_lock    = threading.Lock()
+		self.limit         = AdaptiveLimit(max_concurrency)
+		self.budget        = RetryBudget(retry_ratio)
+		self.max_retries   = max_retries
+		self.backoff_base  = backoff_base
+		self.backoff_cap   = backoff_cap
+		self.cooldown      = cooldown
+		self.last_decrease = None		# When the global rate and limit were last cut
+		self.decrease_lock = threading.Lock()
+		self.clock         = clock
+		self.sleep         = sleep
+
+	def execute(self, request, user=None, http=None):
+		"""
+		Executes a google API request, retrying it with jittered exponential
+		backoff if Google throttles us or has a transient failure. The last
+		error is raised once the retries or the retry budget run out.
+		"""
+		self.budget.deposit()
+		attempt = 0
+		while True:
+			self._wait_for_tokens(user)
+			try:
+				with self.limit:
+					if http is None:
+						response = request.execute()
+					else:
+						response = request.execute(http=http)
+			except Exception as err:
+				throttled = is_throttled(err)
+				if not (throttled or is_transient(err)):
+					raise
+				if throttled:
+					self._throttled(user, err)
+				if attempt >= self.max_retries or not self.budget.withdraw():
+					log.warning("Giving up on google request after {} retries: {}".format(attempt, err))
+					raise
+				# A long Retry-After would park this request's thread, so it is capped too
+				delay = min(self.backoff_cap, max(self.backoff(attempt), retry_after(err)))
+				log.info("Google request failed ({}), retrying in {:.2f}s".format(status_of(err), delay))
+				self.sleep(delay)
+				attempt += 1
+			else:
+				self._succeeded(user)
+				return response
+
+	def backoff(self, attempt):
+		"""Full jitter: a random delay up to base * 2^attempt, capped"""
+		return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+	def user_bucket(self, user):
+		"""Returns the token bucket of a user, creating it if needed"""
+		with self.users_lock:
+			bucket = self.user_buckets.get(user)
+			if bucket is None:
+				bucket = TokenBucket(self.user_rate, self.user_burst, self.clock)
+				self.user_buckets[user] = bucket
+				if len(self.user_buckets) > MAX_USERS:
+					self.user_buckets.popitem(last=False)
+			else:
+				self.user_buckets.move_to_end(user)
+			return bucket
+
+	def _wait_for_tokens(self, user):
+		wait = self.global_bucket.reserve()
+		if user is not None:
+			wait = max(wait, self.user_bucket(user).reserve())
+		if wait > 0:
+			self.sleep(wait)
+
+	def _throttled(self, user, err):
+		if user is not None:
+			self.user_bucket(user).slow_down()
+			if is_user_throttled(err):
+				return		# Only this user's quota is used up, the others can go on
+		with self.decrease_lock:
+			now = self.clock()
+			if self.last_decrease is not None and now - self.last_decrease < self.cooldown:
+				return		# Part of a burst we have already slowed down for
+			self.last_decrease = now
+		self.limit.decrease()
+		self.global_bucket.slow_down()
+
+	def _succeeded(self, user):
+		self.limit.increase()
+		self.global_bucket.speed_up()
+		if user is not None:
+			self.user_bucket(user).speed_up()
+
+
+#############################
+#
+#  Helper Functions
+#
+#############################
+
+def status_of(err):
+	"""Returns the HTTP status of a google HttpError, or 0 for any other exception"""
+	resp = getattr(err, "resp", None)
+	try:
+		return int(getattr(resp, "status", 0))
+	except (TypeError, ValueError):
+		return 0
+
+
+def error_reasons(err):
+	"""Returns the list of 'reason' strings in the body of a google HttpError"""
+	content = getattr(err, "content", None)
+	if not content:
+		return []
+	if isinstance(content, bytes):
+		content = content.decode("utf-8", "replace")
+	try:
+		errors = json.loads(content)["error"].get("errors", [])
+	except (ValueError, KeyError, TypeError, AttributeError):
+		return []
+	return [e.get("reason") for e in errors if isinstance(e, dict)]
+
+
+def is_throttled(err):
+	"""True if the error is Google telling us to slow down"""
+	status = status_of(err)
+	if status in THROTTLE_STATUSES:
+		return True
+	if status == 403:
+		return any(reason in THROTTLE_REASONS for reason in error_reasons(err))
+	return False
+
+
+def is_user_throttled(err):
+	"""True if the error is Google telling one user, rather than the whole app, to slow down"""
+	return (status_of(err) == 403 and
+			any(reason in USER_THROTTLE_REASONS for reason in error_reasons(err)))
+
+
+def is_transient(err):
+	"""True if the error is a server-side failure that is worth retrying"""
+	return status_of(err) in TRANSIENT_STATUSES
+
+
+def retry_after(err):
+	"""Returns the Retry-After header of a google HttpError in seconds, or 0"""
+	resp = getattr(err, "resp", None)
+	try:
+		return float(resp.get("retry-after", 0))
+	except (AttributeError, TypeError, ValueError):
+		return 0.0
+
+
+SCHEDULER = CallScheduler()
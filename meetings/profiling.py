@@ -0,0 +1,212 @@
+"""
+Opt-in profiling of Flask requests, to tell whether a slow request spends its
+time in round trips to Google, in really_between_times, in arrow parsing or in
+rendering templates.
+
+When enabled (PROFILE = True in app.ini / credentials.ini, or --profile on the
+command line), a fraction PROFILE_RATE of the requests, plus every request
+sent with a PROFILE_HEADER header (X-Profile by default) whose value is the
+PROFILE_SECRET, is run under cProfile. The profile of each is dumped as a
+.pstats file in PROFILE_DIR, which can be read with the pstats module, or
+turned into a flame graph with tools like flameprof or snakeviz. Only the
+KEEP most recent files are kept. Streamed responses are profiled until the
+last of their body has been sent.
+
+The slowest of the recently profiled requests, with the functions they spent
+the most time in, are listed as JSON at /_profile. The list shows the paths
+and query strings of requests, so it is only served with the PROFILE_SECRET
+(in the header, or as ?secret=), or when the app runs in debug mode. Without
+a PROFILE_SECRET, the header only triggers profiling in debug mode.
+
+Before python 3.12, cProfile only sees the thread of the request. The events
+of long date ranges are fetched from Google by a pool of threads (see
+from_gcal.list_events_in_chunks), so the time of those fetches shows up as the
+request thread waiting on the pool, in concurrent.futures and threading, not
+as calls to Google. From python 3.12, cProfile sees every thread of the
+process instead: the pool threads, but also any other request running at the
+same time. Only one profile can then run at a time, so a request sampled
+while another one is being profiled is not profiled.
+
+Main Functions:
+configure					: installs a RequestProfiler on the app if profiling is enabled
+
+Classes:
+RequestProfiler
+"""
+
+import collections
+import cProfile
+import hmac
+import logging
+import os
+import pstats
+import random
+import time
+import uuid
+
+import flask
+
+log = logging.getLogger(__name__)
+
+PROFILE_DIR    = os.path.join(os.path.dirname(__file__), "profiles")
+PROFILE_RATE   = 0.1
+PROFILE_HEADER = "X-Profile"
+PROFILE_SECRET = None		# Value of the header, or ?secret=, that unlocks profiling on demand
+KEEP           = 50		# Number of recent profiles listed by /_profile, and kept on disk
+TOP            = 10		# Number of functions listed for each profile
+
+
+def configure(app, config):
+	"""
+	Installs a RequestProfiler on a Flask app if the configuration namespace (as
+	returned by config.configuration()) has PROFILE set, using its PROFILE_DIR,
+	PROFILE_RATE, PROFILE_HEADER and PROFILE_SECRET values or their defaults.
+
+	Returns:
+		the RequestProfiler, or None if profiling is not enabled
+	"""
+	if not getattr(config, "PROFILE", False):
+		return None
+	profiler = RequestProfiler(getattr(config, "PROFILE_DIR", PROFILE_DIR),
+							   float(getattr(config, "PROFILE_RATE", PROFILE_RATE)),
+							   getattr(config, "PROFILE_HEADER", PROFILE_HEADER),
+							   secret=getattr(config, "PROFILE_SECRET", PROFILE_SECRET))
+	profiler.install(app)
+	return profiler
+
+
+class RequestProfiler:
+	"""
+	Runs a sample of requests under cProfile, dumps their profiles into a
+	directory, and keeps a summary of the most recent ones.
+	"""
+
+	def __init__(self, directory, rate=PROFILE_RATE, header=PROFILE_HEADER, keep=KEEP, top=TOP,
+				 secret=PROFILE_SECRET):
+		self.directory = directory
+		self.rate      = rate
+		self.header    = header
+		self.keep      = keep
+		self.top       = top
+		# The configuration may have made a secret of digits an int, for instance
+		self.secret    = None if secret is None else str(secret)
+		self.recent    = collections.deque(maxlen=keep)
+		os.makedirs(directory, exist_ok=True)
+
+	def install(self, app):
+		app.before_request(self.start)
+		app.after_request(self.finish)
+		app.teardown_request(self.abandon)
+		app.add_url_rule("/_profile", "profile_summary", self.summary)
+		log.info("Profiling {:.0%} of requests and those with a {} header into {}".format(
+			self.rate, self.header, self.directory))
+
+	def authorized(self, given):
+		"""
+		True if 'given' is the secret, or if the app is in debug mode and
+		no secret is set. Any value will do in debug mode without a secret.
+		"""
+		if self.secret:
+			return given is not None and hmac.compare_digest(given.encode("utf-8"), self.secret.encode("utf-8"))
+		return flask.current_app.debug
+
+	def wanted(self):
+		"""True if the current request should be profiled"""
+		if flask.request.endpoint in ("profile_summary", "static"):
+			return False
+		if self.header in flask.request.headers and self.authorized(flask.request.headers[self.header]):
+			return True
+		return random.random() < self.rate
+
+	def start(self):
+		if not self.wanted():
+			return
+		profiler = cProfile.Profile()
+		try:
+			profiler.enable()
+		except ValueError:
+			# Another request is being profiled, and profiles are process-wide (python 3.12+)
+			log.debug("Not profiling {}, another profile is running".format(flask.request.full_path))
+			return
+		flask.g.profile = (profiler, time.perf_counter(), flask.request.method,
+						   flask.request.full_path, flask.request.endpoint)
+
+	def finish(self, response):
+		"""Stops profiling, once the body has been sent if the response is streamed"""
+		profile = getattr(flask.g, "profile", None)
+		if profile is not None:
+			flask.g.profile = None
+			if response.is_streamed:
+				response.call_on_close(lambda: self.stop(profile))
+			else:
+				self.stop(profile)
+		return response
+
+	def abandon(self, exc):
+		"""Stops profiling a request that failed before it had a response"""
+		profile = getattr(flask.g, "profile", None)
+		if profile is not None:
+			flask.g.profile = None
+			self.stop(profile)
+
+	def stop(self, profile):
+		profiler, started, method, path, endpoint = profile
+		profiler.disable()
+		seconds = time.perf_counter() - started
+
+		# The process and a random suffix keep files of the same second apart
+		filename = "{}-{}-{}ms-{}-{}.pstats".format(time.strftime("%Y%m%d-%H%M%S"), endpoint or "unknown",
+													int(seconds * 1000), os.getpid(), uuid.uuid4().hex[:8])
+		path_on_disk = os.path.join(self.directory, filename)
+		try:
+			profiler.dump_stats(path_on_disk)
+		except OSError as err:
+			log.warning("Could not write profile {}: {}".format(path_on_disk, err))
+		self.prune()
+
+		self.recent.append({
+			"method": method,
+			"path": path,
+			"endpoint": endpoint,
+			"seconds": round(seconds, 4),
+			"file": filename,
+			"top": self.top_functions(profiler)
+			})
+
+	def prune(self):
+		"""Removes the oldest profiles in the directory, beyond the 'keep' most recent"""
+		profiles = []
+		for name in os.listdir(self.directory):
+			if name.endswith(".pstats"):
+				path = os.path.join(self.directory, name)
+				try:
+					profiles.append((os.stat(path).st_mtime, path))
+				except OSError:
+					pass		# Removed by another process
+		for mtime, path in sorted(profiles, reverse=True)[self.keep:]:
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+
+	def top_functions(self, profiler):
+		"""Returns the functions the profile spent the most time in, itself excluded"""
+		stats = pstats.Stats(profiler).stats
+		ranked = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:self.top]
+		return [{
+			"function": "{}:{}({})".format(os.path.basename(filename), line, name),
+			"calls": calls,
+			"tottime": round(tottime, 4),
+			"cumtime": round(cumtime, 4)
+			} for (filename, line, name), (prim_calls, calls, tottime, cumtime, callers) in ranked]
+
+	def summary(self):
+		"""
+		The slowest of the recently profiled requests, as JSON. Not found unless
+		the secret is given, in the header or as ?secret=, or in debug mode.
+		"""
+		given = flask.request.headers.get(self.header, flask.request.args.get("secret"))
+		if not self.authorized(given):
+			flask.abort(404)
+		slowest = sorted(self.recent, key=lambda entry: entry["seconds"], reverse=True)
+		return flask.jsonify(directory=self.directory, requests=slowest)
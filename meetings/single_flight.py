@@ -0,0 +1,236 @@
+"""
+Coalesces identical concurrent fetches. When several requests ask for the same
+thing at the same time (e.g. a team opening the app together), only the first
+one does the work, and the others wait for it and share its result.
+
+Within a process this is done with a dict of in-flight calls. Across processes
+(e.g. gunicorn workers) it can optionally also be done with one lock file per
+key in a local directory: the first worker to take the lock does the work and
+writes the result next to the lock, and the workers that were waiting on the
+lock read that result instead of doing the work again. Results must be JSON
+serializable to be shared across processes. As they hold private calendar
+data, the directory and its files are only readable by the user running the
+app, and a sweeper thread removes results after RESULT_AGE seconds, and lock
+files not used for LOCK_AGE seconds.
+
+Results are shared, not copied, so callers must not modify them.
+
+The key decides who shares a result. from_gcal keys the fetches from a
+calendar on the calendar, the time window and the access role the user has
+to the calendar, from their own calendarList (see from_gcal.share_scope).
+Google shows the same events to everyone with the same role, so a team
+opening a shared calendar together makes one fetch, while a reader never
+gets the private details an owner sees. Fetches without a known role, like
+the calendar list itself, are only shared by the same user.
+
+Main Functions:
+do									: runs a fetch, coalescing it with identical in-flight fetches
+configure							: replaces the default coalescer using values from a config namespace
+
+Classes:
+SingleFlight
+FileSingleFlight
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+RESULT_AGE = 30			# Seconds after which a shared result is removed by the sweeper
+LOCK_AGE   = 10 * 60		# Seconds after which an unused lock file is removed by the sweeper
+
+
+#############################
+#
+#  Main Functions
+#
+#############################
+
+def do(key, fn):
+	"""
+	Calls fn() and returns its result, unless an identical call (same key) is
+	already in flight, in which case waits for it and returns its result.
+
+	Args:
+		key:	hashable, identifies the fetch. Must be built from everything that
+				affects the result (e.g. calendar id, time window, credentials)
+		fn:		callable taking no arguments, doing the actual fetch
+
+	Returns:
+		the result of fn()
+	"""
+	return COALESCER.do(key, fn)
+
+
+def configure(config):
+	"""
+	Replaces the default coalescer. If the configuration namespace (as returned
+	by config.configuration()) has a COALESCE_DIR, fetches are also coalesced
+	across processes through lock files in that directory.
+	"""
+	global COALESCER
+	directory = getattr(config, "COALESCE_DIR", None)
+	if directory:
+		COALESCER = FileSingleFlight(directory)
+	else:
+		COALESCER = SingleFlight()
+	return COALESCER
+
+
+#############################
+#
+#  Classes
+#
+#############################
+
+class _Call:
+	"""A call in flight, which followers wait on"""
+	def __init__(self):
+		self.done   = threading.Event()
+		self.result = None
+		self.error  = None
+
+
+class SingleFlight:
+	"""Coalesces identical concurrent calls made by the threads of one process"""
+
+	def __init__(self):
+		self.lock  = threading.Lock()
+		self.calls = {}
+
+	def do(self, key, fn):
+		with self.lock:
+			call = self.calls.get(key)
+			leader = call is None
+			if leader:
+				call = _Call()
+				self.calls[key] = call
+
+		if not leader:
+			call.done.wait()
+			if call.error is not None:
+				raise call.error
+			return call.result
+
+		try:
+			call.result = fn()
+		except Exception as err:
+			call.error = err
+			raise
+		finally:
+			with self.lock:
+				del self.calls[key]
+			call.done.set()
+		return call.result
+
+
+class FileSingleFlight(SingleFlight):
+	"""
+	Coalesces identical concurrent calls made by several processes on the same
+	machine, through lock files in a shared directory. Threads of one process
+	are first coalesced in memory, so only one of them waits on the lock file.
+	"""
+
+	def __init__(self, directory):
+		SingleFlight.__init__(self)
+		self.directory = directory
+		self.sweeper   = None		# PID of the process the sweeper thread was started in
+		os.makedirs(directory, mode=0o700, exist_ok=True)
+		os.chmod(directory, 0o700)
+		self.prune()
+
+	def do(self, key, fn):
+		self._start_sweeper()
+		return SingleFlight.do(self, key, lambda: self._do_locked(key, fn))
+
+	def _do_locked(self, key, fn):
+		import fcntl   # Only available on unix, so only needed when coalescing across processes
+
+		name = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+		lock_path   = os.path.join(self.directory, name + ".lock")
+		result_path = os.path.join(self.directory, name + ".json")
+
+		arrived = time.time()
+		lock_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+		try:
+			fcntl.flock(lock_fd, fcntl.LOCK_EX)
+			os.utime(lock_fd)		# Marks the lock as used, for the sweeper
+			# A result written after we arrived comes from a call that was in
+			# flight while we waited on the lock, so we can share it
+			shared = self._read_since(result_path, arrived)
+			if shared is not None:
+				log.debug("Sharing result of another process for {}".format(key))
+				return shared["result"]
+			result = fn()
+			self._write(result_path, result)
+			return result
+		finally:
+			os.close(lock_fd)		# Also releases the lock
+
+	def _read_since(self, path, since):
+		try:
+			if os.stat(path).st_mtime < since:
+				return None
+			with open(path) as f:
+				return json.load(f)
+		except (OSError, ValueError):
+			return None
+
+	def _write(self, path, result):
+		tmp_path = "{}.{}.tmp".format(path, os.getpid())
+		try:
+			with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+				json.dump({"result": result}, f)
+			os.replace(tmp_path, path)
+		except (OSError, TypeError, ValueError) as err:
+			# Not being able to share a result is not a reason to fail the fetch
+			log.warning("Could not share result in {}: {}".format(path, err))
+			try:
+				os.remove(tmp_path)
+			except OSError:
+				pass
+
+	def _start_sweeper(self):
+		"""
+		Starts the thread removing old files, once in each process. Threads don't
+		survive a fork, so a coalescer made in the gunicorn master starts one in
+		each worker on first use.
+		"""
+		if self.sweeper == os.getpid():
+			return
+		with self.lock:
+			if self.sweeper != os.getpid():
+				self.sweeper = os.getpid()
+				threading.Thread(target=self._sweep, daemon=True).start()
+
+	def _sweep(self):
+		while True:
+			time.sleep(RESULT_AGE)
+			self.prune()
+
+	def prune(self):
+		"""
+		Removes result files older than RESULT_AGE seconds, and lock files not used
+		for LOCK_AGE seconds. Removing a lock file that is about to be used again can
+		only cost a duplicate fetch, never a wrong result.
+		"""
+		now = time.time()
+		for name in os.listdir(self.directory):
+			if name.endswith(".lock"):
+				limit = now - LOCK_AGE
+			else:
+				limit = now - RESULT_AGE
+			path = os.path.join(self.directory, name)
+			try:
+				if os.stat(path).st_mtime < limit:
+					os.remove(path)
+			except OSError:
+				pass
+
+
+COALESCER = SingleFlight()
@@ -0,0 +1,125 @@
+"""
+Fakes of the Google Calendar API, and helpers, shared by the test modules.
+This module has no tests of its own.
+"""
+
+import json
+import threading
+import time
+import types
+
+import arrow
+from dateutil import tz
+
+# Configuration namespace for create_app() in the tests, see configured_app()
+TEST_CONFIG = types.SimpleNamespace(DEBUG=False, SECRET_KEY="test", GOOGLE_KEY_FILE="none")
+
+
+class FakeResponse(dict):
+	"""The 'resp' of a google HttpError: the headers, with the status as an attribute"""
+	def __init__(self, status):
+		dict.__init__(self)
+		self.status = status
+
+
+class FakeHttpError(Exception):
+	"""A google HttpError with a status, and optionally an error reason in its body"""
+	def __init__(self, status, reason=None):
+		Exception.__init__(self, status)
+		self.resp = FakeResponse(status)
+		body = {"error": {"errors": [{"reason": reason}]}} if reason else {}
+		self.content = json.dumps(body).encode("utf-8")
+
+
+class FakeRequest:
+	"""
+	A google API request, which fails with the given errors, in order, and then
+	returns the response. 'on_execute' is called on every execution.
+	"""
+	def __init__(self, response, errors=(), on_execute=None):
+		self.response = response
+		self.errors = list(errors)
+		self.on_execute = on_execute
+		self.calls = 0
+
+	def execute(self, http=None):
+		self.calls += 1
+		if self.on_execute:
+			self.on_execute()
+		if self.errors:
+			raise self.errors.pop(0)
+		return self.response
+
+
+class FakeService:
+	"""
+	A google calendar 'service' object over a dict of calendar IDs to lists of
+	non-recurring events. It is both service.calendarList() and service.events().
+	Events overlapping the requested range are listed 'page_size' per page (all
+	at once by default), and each execution of a listing takes 'delay' seconds,
+	or fails with 'error' if one is given.
+
+	Records the listings asked for in 'listed', how many were executed in
+	'executed', and the events fetched one by one in 'gets'.
+	"""
+	def __init__(self, calendars, page_size=None, delay=0, error=None):
+		self.calendars = calendars
+		self.page_size = page_size
+		self.delay = delay
+		self.error = error
+		self.listed = []
+		self.executed = 0
+		self.gets = []
+		self.lock = threading.Lock()
+
+	def calendarList(self):
+		return self
+
+	def events(self):
+		return self
+
+	def list(self, calendarId=None, timeMin=None, timeMax=None, pageToken=None):
+		if calendarId is None:
+			return FakeRequest({"items": [{"kind": "calendar#calendarListEntry", "id": cal_id, "summary": cal_id,
+										   "selected": True, "accessRole": "owner"} for cal_id in self.calendars]})
+		self.listed.append((calendarId, timeMin, timeMax, pageToken))
+		overlapping = [e for e in self.calendars[calendarId]
+					   if arrow.get(e['start']['dateTime']) < arrow.get(timeMax)
+					   and arrow.get(e['end']['dateTime']) > arrow.get(timeMin)]
+		first = int(pageToken or 0)
+		size = self.page_size or len(overlapping) or 1
+		page = {"items": overlapping[first:first + size]}
+		if first + size < len(overlapping):
+			page["nextPageToken"] = str(first + size)
+		return FakeRequest(page, [self.error] if self.error else [], self.count_executed)
+
+	def count_executed(self):
+		with self.lock:
+			self.executed += 1
+		time.sleep(self.delay)
+
+	def get(self, calendarId, eventId):
+		self.gets.append((calendarId, eventId))
+		return FakeRequest(next(e for e in self.calendars[calendarId] if e['id'] == eventId))
+
+
+def make_event(event_id, begin, end, **fields):
+	"""A google event dict, with the isoformatted begin and end, and any other fields"""
+	event = {"id": event_id, "summary": event_id, "start": {"dateTime": begin}, "end": {"dateTime": end}}
+	event.update(fields)
+	return event
+
+
+def local(text):
+	"""'2013-05-12 10:00' as an isoformatted time in the local timezone, as the app uses"""
+	return arrow.get(text, "YYYY-MM-DD HH:mm").replace(tzinfo=tz.tzlocal()).isoformat()
+
+
+def configured_app():
+	"""
+	Returns flask_main, with its app configured from TEST_CONFIG unless it already
+	is. flask_main is only imported here, so the other tests don't need Flask.
+	"""
+	import flask_main
+	flask_main.create_app(configuration=TEST_CONFIG)
+	return flask_main
@@ -0,0 +1,73 @@
+"""
+This test module tests the streaming busy times API through the Flask test
+client, with a fake Google Calendar service in place of Google.
+"""
+
+import contextlib
+import json
+from unittest import mock
+import fakes
+from fakes import FakeService, local
+
+flask_main = fakes.configured_app()
+
+
+def make_event(event_id, begin, end):
+	return fakes.make_event(event_id, local(begin), local(end), iCalUID=event_id + "@example.com")
+
+
+@contextlib.contextmanager
+def fake_google(authorized=True):
+	"""Gives a test client, while the credentials and the service the views get are fakes"""
+	service = FakeService({"me": [make_event("standup", "2013-05-12 10:00", "2013-05-12 11:00"),
+								  make_event("dinner",  "2013-05-12 19:00", "2013-05-12 20:00")],
+						   "team": [make_event("retro", "2013-05-13 14:00", "2013-05-13 15:00")]})
+	with mock.patch.multiple(flask_main, valid_credentials=lambda: authorized and "credentials",
+							 get_gcal_service=lambda credentials: service,
+							 http_factory=lambda credentials: None):
+		yield flask_main.app.test_client()
+
+
+RANGE = "begin_date=05/12/2013&end_date=05/13/2013&begin_time=9am&end_time=5pm"
+
+
+def test_streams_one_instance_per_line():
+	print("Busy times within the range are streamed as one JSON object per line")
+	with fake_google() as client:
+		response = client.get("/api/busytimes?calendar=me&calendar=team&" + RANGE)
+		assert response.status_code == 200
+		assert response.mimetype == "application/x-ndjson"
+		lines = response.get_data(as_text=True).splitlines()
+		assert [json.loads(line)['summary'] for line in lines] == ["standup", "retro"]
+
+
+def test_not_authorized():
+	print("Without credentials, the API answers 401 rather than redirecting")
+	with fake_google(authorized=False) as client:
+		response = client.get("/api/busytimes?calendar=me&" + RANGE)
+		assert response.status_code == 401
+		assert "error" in json.loads(response.get_data(as_text=True))
+
+
+def test_missing_calendar():
+	print("At least one calendar is needed")
+	with fake_google() as client:
+		assert client.get("/api/busytimes?" + RANGE).status_code == 400
+
+
+def test_missing_parameter():
+	print("A range missing from both the arguments and the session is named in the error")
+	with fake_google() as client:
+		response = client.get("/api/busytimes?calendar=me&begin_date=05/12/2013")
+		assert response.status_code == 400
+		assert "end_date" in json.loads(response.get_data(as_text=True))['error']
+
+
+def test_bad_date_not_flashed():
+	print("A bad date is a 400, and no message is flashed into the caller's session")
+	with fake_google() as client:
+		response = client.get("/api/busytimes?calendar=me&" + RANGE.replace("05/12/2013", "12 May"))
+		assert response.status_code == 400
+		assert "Dates must be" in json.loads(response.get_data(as_text=True))['error']
+		with client.session_transaction() as session:
+			assert "_flashes" not in session
@@ -0,0 +1,92 @@
+"""
+This test module tests that the app is configured by create_app(), or by its
+first request, and that the Google client modules and the Calendar API
+description are only loaded when needed or preloaded.
+"""
+
+import os
+import subprocess
+import sys
+import threading
+import types
+from unittest import mock
+import flask_main
+import fakes
+from fakes import FakeResponse, TEST_CONFIG
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def fake_google(status=200):
+	"""Google client modules whose Http records how it is made and used"""
+	made = []
+	class Http:
+		def __init__(self, timeout=None):
+			self.timeout = timeout
+
+		def request(self, url):
+			# Whether another thread could configure the app or import modules meanwhile
+			free = []
+			def try_lock():
+				free.append(flask_main._init_lock.acquire(timeout=1))
+				if free[0]:
+					flask_main._init_lock.release()
+			waiter = threading.Thread(target=try_lock)
+			waiter.start()
+			waiter.join()
+			made.append({"timeout": self.timeout, "url": url, "init_lock_free": free[0]})
+			return FakeResponse(status), b'{"kind": "discovery#restDescription"}'
+	discovery = types.SimpleNamespace(DISCOVERY_URI="https://example.com/{api}/{apiVersion}/rest")
+	return types.SimpleNamespace(client=None, httplib2=types.SimpleNamespace(Http=Http), discovery=discovery), made
+
+
+def test_import_does_not_load_google():
+	print("Importing the app does not import the Google client modules")
+	output = subprocess.check_output([sys.executable, "-c",
+									  "import sys, flask_main; print('oauth2client' in sys.modules)"], cwd=HERE)
+	assert output.decode().split()[-1] == "False"
+
+
+def test_first_request_configures():
+	print("Without create_app(), the first request configures the app, session included")
+	with mock.patch.object(flask_main, "CONFIG", None), \
+		 mock.patch.object(flask_main.config, "configuration", lambda proxied: TEST_CONFIG):
+		response = flask_main.app.test_client().get("/")
+		assert response.status_code == 200
+		assert flask_main.CONFIG is TEST_CONFIG
+		assert "session=" in response.headers.get("Set-Cookie", "")
+
+
+def test_config_set_last():
+	print("CONFIG is only set once the app and the modules are configured, for requests not taking the lock")
+	seen = []
+	def configure_profiling(app, configuration):
+		seen.append((flask_main.CONFIG, app.secret_key))
+	with mock.patch.object(flask_main, "CONFIG", None), \
+		 mock.patch.object(flask_main.profiling, "configure", configure_profiling):
+		flask_main.create_app(configuration=TEST_CONFIG)
+		assert seen == [(None, "test")]
+		assert flask_main.CONFIG is TEST_CONFIG
+
+
+def test_preload_fetches_calendar_api():
+	print("Preloading fetches the Calendar API description, with a timeout and without the init lock")
+	google, made = fake_google()
+	fakes.configured_app()
+	with mock.patch.multiple(flask_main, GOOGLE=google, CALENDAR_API=None):
+		assert flask_main.create_app(preload=True) is flask_main.app
+		assert flask_main.CALENDAR_API == '{"kind": "discovery#restDescription"}'
+		assert made == [{"timeout": flask_main.DISCOVERY_TIMEOUT, "url": "https://example.com/calendar/v3/rest",
+						 "init_lock_free": True}]
+		flask_main.calendar_api()
+		assert len(made) == 1		# Fetched once per process
+
+
+def test_preload_failure_left_to_workers():
+	print("A failed preload is only logged, and the first request that needs it tries again")
+	google, made = fake_google(status=503)
+	fakes.configured_app()
+	with mock.patch.multiple(flask_main, GOOGLE=google, CALENDAR_API=None):
+		flask_main.create_app(preload=True)
+		assert flask_main.CALENDAR_API is None
+		assert len(made) == 1
@@ -0,0 +1,60 @@
+"""
+This test module tests the busy fractions computed from the bitmaps of the
+busy times of several calendars.
+"""
+
+from busy_bitmap import utilization, make_grid, rasterize, count_busy
+
+BEGIN_DATE = '2013-05-12T00:00:00+00:00'
+END_DATE   = '2013-05-13T00:00:00+00:00'
+BEGIN_TIME = '2000-01-01T09:00:00+00:00'
+END_TIME   = '2000-01-01T17:00:00+00:00'
+
+
+def make_instance(begin, end, *cal_ids):
+	return {"begin_datetime": begin, "end_datetime": end, "cal_ids": list(cal_ids)}
+
+
+def test_rasterize_rounds_out_to_slots():
+	print("An instance sets every slot it touches, even partly")
+	grid = make_grid('2013-05-12T09:00:00+00:00', '2013-05-12T17:00:00+00:00', 15)
+	assert grid['size'] == 32
+	bits = rasterize(grid, '2013-05-12T09:10:00+00:00', '2013-05-12T09:40:00+00:00')
+	assert bits == 0b111
+	assert count_busy(bits, 1, 32) == 2
+
+
+def test_union_and_intersection():
+	print("Union and intersection fractions of two calendars on two days")
+	instances = [
+		make_instance('2013-05-12T09:00:00+00:00', '2013-05-12T11:00:00+00:00', "me"),
+		make_instance('2013-05-12T10:00:00+00:00', '2013-05-12T13:00:00+00:00', "team"),
+		make_instance('2013-05-13T16:00:00+00:00', '2013-05-13T20:00:00+00:00', "me", "team"),
+	]
+	summary = utilization(instances, BEGIN_DATE, END_DATE, BEGIN_TIME, END_TIME, 30)
+	first, second = summary['days']
+	assert first['date'] == '2013-05-12'
+	assert first['any'] == 4 / 8				# 9 to 1 of 9 to 5
+	assert first['all'] == 1 / 8				# 10 to 11
+	assert first['calendars'] == {"me": 2 / 8, "team": 3 / 8}
+	assert second['any'] == second['all'] == 1 / 8		# Clipped to 4 to 5
+	assert summary['total']['any'] == 5 / 16
+
+
+def test_no_instances():
+	print("Nothing is busy without instances")
+	summary = utilization([], BEGIN_DATE, END_DATE, BEGIN_TIME, END_TIME)
+	assert [d['any'] for d in summary['days']] == [0.0, 0.0]
+	assert summary['total']['all'] == 0.0
+
+
+def test_free_selected_calendar():
+	print("A selected calendar without instances is free, so nothing is busy on all calendars")
+	instances = [make_instance('2013-05-12T09:00:00+00:00', '2013-05-12T10:00:00+00:00', "me")]
+	summary = utilization(instances, BEGIN_DATE, END_DATE, BEGIN_TIME, END_TIME,
+						  selected_cal=["me", "team"])
+	first = summary['days'][0]
+	assert first['any'] == 1 / 8
+	assert first['all'] == 0.0
+	assert first['calendars'] == {"me": 1 / 8, "team": 0.0}
+	assert summary['total']['calendars']['team'] == 0.0
@@ -0,0 +1,56 @@
+"""
+This test module tests that long date ranges are split into chunks, and that the
+events of the chunks are merged back in time order without duplicates.
+"""
+
+import threading
+import from_gcal
+from from_gcal import split_time_range, list_events_in_chunks, share_scope
+from fakes import FakeService, make_event
+
+
+def test_split_time_range():
+	print("A range of 10 days is split in chunks of at most 4 days")
+	chunks = split_time_range('2013-05-01T00:00:00+00:00', '2013-05-11T00:00:00+00:00', 4)
+	assert chunks == [
+		('2013-05-01T00:00:00+00:00', '2013-05-05T00:00:00+00:00'),
+		('2013-05-05T00:00:00+00:00', '2013-05-09T00:00:00+00:00'),
+		('2013-05-09T00:00:00+00:00', '2013-05-11T00:00:00+00:00')
+	]
+
+
+def test_chunks_merged_in_order_without_duplicates():
+	print("Events across chunk boundaries are returned once, in time order")
+	service = FakeService({"cal": [
+		make_event("late",    '2013-05-03T10:00:00+00:00', '2013-05-03T11:00:00+00:00'),
+		make_event("across",  '2013-05-01T23:00:00+00:00', '2013-05-02T01:00:00+00:00'),
+		make_event("early",   '2013-05-01T09:00:00+00:00', '2013-05-01T10:00:00+00:00'),
+		make_event("early2",  '2013-05-01T11:00:00+00:00', '2013-05-01T12:00:00+00:00'),
+		make_event("early3",  '2013-05-01T13:00:00+00:00', '2013-05-01T14:00:00+00:00'),
+	]}, page_size=2)
+	chunk_days, from_gcal.CHUNK_DAYS = from_gcal.CHUNK_DAYS, 1
+	try:
+		events = list(list_events_in_chunks(service, ["cal"], '2013-05-01T00:00:00+00:00',
+											'2013-05-04T00:00:00+00:00', "chunk-test"))
+	finally:
+		from_gcal.CHUNK_DAYS = chunk_days
+	assert [e['id'] for cal_id, e in events] == ["early", "early2", "early3", "across", "late"]
+	assert len(service.listed) == 4		# Three chunks, the first of which has two pages
+
+
+def test_fetches_shared_by_users_with_same_role():
+	print("Users with the same role to a calendar share a fetch, other roles do not")
+	service = FakeService({"team": [make_event("a", '2013-05-01T09:00:00+00:00', '2013-05-01T10:00:00+00:00')]},
+						  delay=0.2)
+	users = [("alice", "reader"), ("bob", "reader"), ("carol", "owner")]
+	threads = [threading.Thread(target=lambda user=user, role=role: list(list_events_in_chunks(
+				   service, ["team"], '2013-05-01T00:00:00+00:00', '2013-05-02T00:00:00+00:00', user,
+				   roles={"team": role})))
+			   for user, role in users]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	assert service.executed == 2		# One for the readers, one for the owner
+	assert share_scope("team", "alice", {"team": "reader"}) == share_scope("team", "bob", {"team": "reader"})
+	assert share_scope("other", "alice", {"team": "reader"}) == ("user", "alice")
@@ -0,0 +1,43 @@
+"""
+This test module tests that an event shared by several of the selected calendars
+is only fetched and returned once, and remembers which calendars it came from.
+"""
+
+from from_gcal import list_instances_btwn_times_in_dates, event_dedupe_key
+import fakes
+from fakes import FakeService
+
+BEGIN_DATE = '2013-05-12T00:00:00+00:00'
+END_DATE   = '2013-05-13T00:00:00+00:00'
+BEGIN_TIME = '2000-01-01T09:00:00+00:00'
+END_TIME   = '2000-01-01T17:00:00+00:00'
+
+
+def make_event(event_id, ical_uid, summary):
+	return fakes.make_event(event_id, "2013-05-12T10:00:00+00:00", "2013-05-12T11:00:00+00:00",
+							iCalUID=ical_uid, summary=summary)
+
+
+def test_shared_event_fetched_once():
+	print("An event on two selected calendars is fetched and returned once")
+	service = FakeService({
+		"me":   [make_event("a", "standup@example.com", "Standup")],
+		"team": [make_event("a", "standup@example.com", "Standup"),
+				 make_event("b", "retro@example.com", "Retro")]
+	})
+	result = list_instances_btwn_times_in_dates(service, ["me", "team"], BEGIN_DATE, END_DATE,
+												BEGIN_TIME, END_TIME, "dedupe-test")
+	assert [i['summary'] for i in result] == ["Standup", "Retro"]
+	assert result[0]['cal_ids'] == ["me", "team"]
+	assert result[1]['cal_ids'] == ["team"]
+	assert service.gets == [("me", "a"), ("team", "b")]
+
+
+def test_modified_instances_kept_apart():
+	print("Modified instances of a recurring event share its iCalUID but are not duplicates")
+	master = make_event("a", "weekly@example.com", "Weekly")
+	moved = make_event("a_1", "weekly@example.com", "Weekly")
+	moved['recurringEventId'] = "a"
+	moved['originalStartTime'] = {"dateTime": "2013-05-12T10:00:00+00:00"}
+	assert event_dedupe_key(master) != event_dedupe_key(moved)
+	assert event_dedupe_key(moved) == event_dedupe_key(dict(moved, id="other_copy"))
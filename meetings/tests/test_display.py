@@ -0,0 +1,80 @@
+"""
+This test module tests that the busy times page is sent before the busy times
+are fetched, and that its pages are slices of one fetch.
+"""
+
+import contextlib
+import types
+from unittest import mock
+import fakes
+from fakes import FakeHttpError, FakeService, local
+
+flask_main = fakes.configured_app()
+
+
+def make_events(count):
+	return [fakes.make_event("e{}".format(i), local("2013-05-12 {:02}:00".format(9 + i)),
+							 local("2013-05-12 {:02}:30".format(9 + i)), summary="Event {}".format(i))
+			for i in range(count)]
+
+
+@contextlib.contextmanager
+def display_client(service, page_size=2):
+	"""Gives a test client whose session has the calendar 'me' selected, showing the fake service"""
+	with mock.patch.multiple(flask_main, CONFIG=types.SimpleNamespace(PAGE_SIZE=page_size),
+							 valid_credentials=lambda: "credentials",
+							 get_gcal_service=lambda credentials: service,
+							 http_factory=lambda credentials: None):
+		client = flask_main.app.test_client()
+		with client.session_transaction() as session:
+			session['begin_date'] = local("2013-05-12 00:00")
+			session['end_date']   = local("2013-05-12 23:59")
+			session['begin_time'] = local("2016-01-01 09:00")
+			session['end_time']   = local("2016-01-01 17:00")
+			session['selected_cal'] = ["me"]
+		yield client
+
+
+def test_head_sent_before_fetch():
+	print("The head of the page is streamed before any busy times are fetched")
+	service = FakeService({"me": make_events(3)})
+	with display_client(service) as client:
+		response = client.get("/display")
+		chunks = response.iter_encoded()
+		assert b"<head>" in next(chunks)
+		assert service.executed == 0
+		body = b"".join(chunks).decode("utf-8")
+		response.close()
+		assert service.executed == 1
+		assert "Event 0" in body and "Event 1" in body and "Event 2" not in body
+		assert "Page 1 of 2 (3 busy times)" in body
+
+
+def test_pages_are_slices_of_one_fetch():
+	print("Paging through the busy times of a query does not fetch them again")
+	service = FakeService({"me": make_events(3)})
+	with display_client(service) as client:
+		client.get("/display").get_data()
+		body = client.get("/display?page=2").get_data(as_text=True)
+		assert service.executed == 1
+		assert "Event 2" in body and "Event 0" not in body
+		assert "Page 2 of 2" in body
+
+
+def test_no_busy_times():
+	print("A query without busy times says so")
+	with display_client(FakeService({"me": []})) as client:
+		body = client.get("/display").get_data(as_text=True)
+		assert "No busy times" in body
+		assert "Page 1" not in body
+
+
+def test_fetch_error_shown():
+	print("A fetch failing after the head was sent is shown after the rows, and not kept")
+	service = FakeService({"me": make_events(3)}, error=FakeHttpError(404))
+	with display_client(service) as client:
+		body = client.get("/display").get_data(as_text=True)
+		assert "Could not get all your busy times" in body
+		assert "No busy times" not in body
+		client.get("/display").get_data()
+		assert service.executed == 2
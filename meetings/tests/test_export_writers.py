@@ -0,0 +1,72 @@
+"""
+This test module tests the free blocks left between busy blocks, and the
+iCalendar and CSV writers used to export them.
+"""
+
+import io
+import export_writers
+from export_writers import free_blocks, iter_csv, iter_ics, fold, read_instances
+
+BEGIN_DATE = '2013-05-12T00:00:00+00:00'
+END_DATE   = '2013-05-13T00:00:00+00:00'
+BEGIN_TIME = '2000-01-01T09:00:00+00:00'
+END_TIME   = '2000-01-01T17:00:00+00:00'
+
+
+def make_instance(begin, end, summary="Busy"):
+	return {"event_id": "e", "summary": summary, "begin_datetime": begin, "end_datetime": end}
+
+
+def test_free_blocks():
+	print("Free blocks are the gaps between overlapping busy blocks, on each day")
+	instances = [
+		make_instance('2013-05-12T12:00:00+00:00', '2013-05-12T13:00:00+00:00'),
+		make_instance('2013-05-12T08:00:00+00:00', '2013-05-12T10:00:00+00:00'),
+		make_instance('2013-05-12T09:30:00+00:00', '2013-05-12T11:00:00+00:00'),
+		make_instance('2013-05-12T16:00:00+00:00', '2013-05-13T10:00:00+00:00'),
+	]
+	blocks = list(free_blocks(instances, BEGIN_DATE, END_DATE, BEGIN_TIME, END_TIME))
+	assert [(b['begin_datetime'][11:16], b['end_datetime'][11:16]) for b in blocks] == [
+		("11:00", "12:00"), ("13:00", "16:00"), ("10:00", "17:00")]
+
+
+def test_free_whole_day():
+	print("The same begin and end time means the whole day is free, less the busy blocks")
+	instances = [make_instance('2013-05-12T12:00:00+00:00', '2013-05-12T13:00:00+00:00')]
+	blocks = list(free_blocks(instances, BEGIN_DATE, BEGIN_DATE, BEGIN_TIME, BEGIN_TIME))
+	assert [(b['begin_datetime'], b['end_datetime']) for b in blocks] == [
+		('2013-05-12T09:00:00+00:00', '2013-05-12T12:00:00+00:00'),
+		('2013-05-12T13:00:00+00:00', '2013-05-13T09:00:00+00:00')]
+
+
+def test_ics_freebusy():
+	print("A VFREEBUSY has one UTC period per block, with CRLF line endings")
+	blocks = [make_instance('2013-05-12T09:00:00-07:00', '2013-05-12T10:00:00-07:00')]
+	ics = "".join(iter_ics(blocks, freebusy=True))
+	assert "FREEBUSY;FBTYPE=BUSY:20130512T160000Z/20130512T170000Z\r\n" in ics
+	assert ics.startswith("BEGIN:VCALENDAR\r\n") and ics.endswith("END:VCALENDAR\r\n")
+
+
+def test_fold_long_lines():
+	print("Long lines are folded into lines of at most 75 octets")
+	folded = fold("SUMMARY:" + "é" * 60)
+	assert all(len(line.encode("utf-8")) <= 75 for line in folded.split("\r\n"))
+	assert folded.replace("\r\n ", "") == "SUMMARY:" + "é" * 60
+
+
+def test_csv_written_in_chunks():
+	print("CSV rows are written a chunk at a time")
+	chunk_lines, export_writers.CHUNK_LINES = export_writers.CHUNK_LINES, 10
+	try:
+		blocks = (make_instance('2013-05-12T09:00:00+00:00', '2013-05-12T10:00:00+00:00') for i in range(25))
+		chunks = list(iter_csv(blocks))
+	finally:
+		export_writers.CHUNK_LINES = chunk_lines
+	assert len(chunks) == 3
+	assert "".join(chunks).count("\r\n") == 26
+
+
+def test_read_saved_ndjson():
+	print("Busy times saved as NDJSON are read back, skipping errors")
+	saved = io.StringIO('{"summary": "a"}\n\n{"error": "failed"}\n{"summary": "b"}\n')
+	assert [i['summary'] for i in read_instances(saved)] == ["a", "b"]
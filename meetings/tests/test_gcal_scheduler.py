@@ -0,0 +1,101 @@
+"""
+This test module tests that calls to Google are retried with backoff when
+Google throttles us, and that the throttling slows the scheduler down.
+"""
+
+from gcal_scheduler import CallScheduler, is_throttled
+from fakes import FakeHttpError, FakeRequest
+
+
+def failing(*errors):
+	"""A request that fails with the given errors, in order, and then succeeds"""
+	return FakeRequest({"items": []}, errors)
+
+
+def make_scheduler(**kwargs):
+	sleeps = []
+	scheduler = CallScheduler(sleep=sleeps.append, **kwargs)
+	return scheduler, sleeps
+
+
+def test_throttled_errors():
+	print("Rate limit errors are recognized, other errors are not")
+	assert is_throttled(FakeHttpError(429))
+	assert is_throttled(FakeHttpError(403, "userRateLimitExceeded"))
+	assert is_throttled(FakeHttpError(403, "rateLimitExceeded"))
+	assert not is_throttled(FakeHttpError(403, "forbidden"))
+	assert not is_throttled(ValueError("not an http error"))
+
+
+def test_retries_until_success():
+	print("Throttled calls are retried with backoff until they succeed")
+	scheduler, sleeps = make_scheduler()
+	request = failing(FakeHttpError(429), FakeHttpError(403, "userRateLimitExceeded"))
+	assert scheduler.execute(request, user="u") == {"items": []}
+	assert request.calls == 3
+	assert len(sleeps) == 2
+
+
+def test_gives_up_after_max_retries():
+	print("The last error is raised once the retries run out")
+	scheduler, sleeps = make_scheduler(max_retries=2)
+	request = failing(*[FakeHttpError(429) for i in range(5)])
+	try:
+		scheduler.execute(request)
+		assert False
+	except FakeHttpError:
+		pass
+	assert request.calls == 3
+
+
+def test_other_errors_not_retried():
+	print("Errors that are not throttling or transient are raised immediately")
+	scheduler, sleeps = make_scheduler()
+	request = failing(FakeHttpError(404))
+	try:
+		scheduler.execute(request)
+		assert False
+	except FakeHttpError:
+		pass
+	assert request.calls == 1
+	assert sleeps == []
+
+
+def test_throttling_slows_down():
+	print("Throttling cuts the concurrency limit and the user's rate")
+	scheduler, sleeps = make_scheduler(max_concurrency=8, user_rate=4.0)
+	scheduler.execute(failing(FakeHttpError(429)), user="u")
+	assert scheduler.limit.limit < 8
+	assert scheduler.user_bucket("u").rate < 4.0
+
+
+def test_retry_after_capped():
+	print("A long Retry-After header is capped by the longest backoff")
+	scheduler, sleeps = make_scheduler(backoff_cap=4.0)
+	error = FakeHttpError(429)
+	error.resp["retry-after"] = "600"
+	scheduler.execute(failing(error))
+	assert sleeps == [4.0]
+
+
+def test_user_throttling_only_slows_that_user():
+	print("A user's rate limit slows that user down, not the other users or the process")
+	scheduler, sleeps = make_scheduler(max_concurrency=8, global_rate=10.0, user_rate=5.0)
+	for i in range(8):
+		scheduler.execute(failing(FakeHttpError(403, "userRateLimitExceeded")), user="alice")
+	assert scheduler.user_bucket("alice").rate < 5.0
+	assert scheduler.user_bucket("bob").rate == 5.0
+	assert scheduler.global_bucket.rate == 10.0
+	assert scheduler.limit.limit == 8
+
+
+def test_burst_of_throttles_counts_once():
+	print("Throttles within the cooldown are one decrease of the global rate and limit")
+	now = [100.0]
+	scheduler, sleeps = make_scheduler(max_concurrency=8, cooldown=2.0, clock=lambda: now[0])
+	for i in range(3):
+		scheduler.execute(failing(FakeHttpError(429)))
+	assert 4 <= scheduler.limit.limit < 5
+	now[0] += 3.0
+	scheduler.execute(failing(FakeHttpError(403, "rateLimitExceeded")))
+	assert 2 <= scheduler.limit.limit < 3
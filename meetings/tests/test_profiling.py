@@ -0,0 +1,85 @@
+"""
+This test module tests which requests are profiled, who can list them, and
+that only the most recent profiles are kept on disk.
+"""
+
+import cProfile
+import os
+import tempfile
+from unittest import mock
+import flask
+from profiling import RequestProfiler
+
+
+def make_app(secret="s3cret", keep=50, debug=False):
+	"""A small app with one view, profiled into a new directory, never at random"""
+	app = flask.Flask(__name__)
+	app.debug = debug
+	app.add_url_rule("/", "hello", lambda: "Hello")
+	profiler = RequestProfiler(tempfile.mkdtemp(), rate=0.0, keep=keep, secret=secret)
+	profiler.install(app)
+	return app, profiler
+
+
+def test_header_needs_secret():
+	print("The header only triggers profiling with the secret as its value")
+	app, profiler = make_app()
+	client = app.test_client()
+	client.get("/", headers={"X-Profile": "guess"})
+	client.get("/", headers={"X-Profile": ""})
+	assert os.listdir(profiler.directory) == []
+	client.get("/", headers={"X-Profile": "s3cret"})
+	assert len(os.listdir(profiler.directory)) == 1
+	assert profiler.recent[0]["endpoint"] == "hello"
+
+
+def test_header_without_secret_only_in_debug():
+	print("Without a secret, the header only triggers profiling in debug mode")
+	app, profiler = make_app(secret=None)
+	app.test_client().get("/", headers={"X-Profile": "1"})
+	assert os.listdir(profiler.directory) == []
+	app.debug = True
+	app.test_client().get("/", headers={"X-Profile": "1"})
+	assert len(os.listdir(profiler.directory)) == 1
+
+
+def test_summary_needs_secret():
+	print("/_profile is not found without the secret, in the header or as an argument")
+	app, profiler = make_app()
+	client = app.test_client()
+	assert client.get("/_profile").status_code == 404
+	assert client.get("/_profile?secret=guess").status_code == 404
+	assert client.get("/_profile?secret=s3cret").status_code == 200
+	assert client.get("/_profile", headers={"X-Profile": "s3cret"}).status_code == 200
+
+
+def test_oldest_profiles_removed():
+	print("Only the 'keep' most recent profiles stay on disk, each in its own file")
+	app, profiler = make_app(keep=2)
+	client = app.test_client()
+	for i in range(4):
+		client.get("/", headers={"X-Profile": "s3cret"})
+	kept = sorted(os.listdir(profiler.directory))
+	assert len(kept) == 2
+	assert set(kept) <= {entry["file"] for entry in profiler.recent}
+	assert len({entry["file"] for entry in profiler.recent}) == 2
+
+
+def test_secret_of_digits():
+	print("A secret the configuration read as a number still works")
+	app, profiler = make_app(secret=20240101)
+	response = app.test_client().get("/", headers={"X-Profile": "20240101"})
+	assert response.status_code == 200
+	assert len(os.listdir(profiler.directory)) == 1
+
+
+def test_busy_profiler_skipped():
+	print("A request is not profiled, but still served, while another profile is running")
+	class BusyProfile(cProfile.Profile):
+		def enable(self):
+			raise ValueError("Another profiling tool is already active")
+	app, profiler = make_app()
+	with mock.patch("profiling.cProfile.Profile", BusyProfile):
+		response = app.test_client().get("/", headers={"X-Profile": "s3cret"})
+	assert response.status_code == 200
+	assert os.listdir(profiler.directory) == []
@@ -0,0 +1,110 @@
+"""
+This test module tests that identical concurrent fetches share one result,
+both between threads and through the lock file directory.
+"""
+
+import os
+import stat
+import tempfile
+import threading
+import time
+import single_flight
+from single_flight import SingleFlight, FileSingleFlight
+
+
+def run_concurrently(coalescer, key, fn, count=5):
+	"""Calls coalescer.do(key, fn) from 'count' threads at once"""
+	results = []
+	threads = [threading.Thread(target=lambda: results.append(coalescer.do(key, fn)))
+			   for i in range(count)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return results
+
+
+def slow_counter():
+	"""Returns a fetch function that is slow, and a list counting its calls"""
+	calls = []
+	def fetch():
+		calls.append(1)
+		time.sleep(0.2)
+		return {"items": [len(calls)]}
+	return fetch, calls
+
+
+def test_concurrent_fetches_coalesced():
+	print("Identical concurrent fetches make one call and share its result")
+	fetch, calls = slow_counter()
+	results = run_concurrently(SingleFlight(), ("events", "cal"), fetch)
+	assert len(calls) == 1
+	assert results == [{"items": [1]}] * 5
+
+
+def test_sequential_fetches_not_coalesced():
+	print("A fetch made after the previous one finished makes its own call")
+	fetch, calls = slow_counter()
+	coalescer = SingleFlight()
+	coalescer.do("key", fetch)
+	coalescer.do("key", fetch)
+	assert len(calls) == 2
+
+
+def test_errors_shared():
+	print("Followers see the error of the call they waited on")
+	def fetch():
+		time.sleep(0.2)
+		raise ValueError("failed")
+	errors = []
+	def follow():
+		try:
+			coalescer.do("key", fetch)
+		except ValueError as err:
+			errors.append(err)
+	coalescer = SingleFlight()
+	threads = [threading.Thread(target=follow) for i in range(3)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	assert len(errors) == 3
+
+
+def test_file_coalescing_across_instances():
+	print("Two coalescers sharing a directory, like two workers, share one call")
+	fetch, calls = slow_counter()
+	directory = tempfile.mkdtemp()
+	workers = [FileSingleFlight(directory), FileSingleFlight(directory)]
+	results = []
+	threads = [threading.Thread(target=lambda w=w: results.append(w.do(("events", "cal"), fetch)))
+			   for w in workers]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	assert len(calls) == 1
+	assert results == [{"items": [1]}] * 2
+
+
+def test_files_private_and_pruned():
+	print("Shared results are only readable by us, and old files are swept away")
+	directory = os.path.join(tempfile.mkdtemp(), "coalesce")
+	coalescer = FileSingleFlight(directory)
+	coalescer.do("key", lambda: {"items": []})
+	assert stat.S_IMODE(os.stat(directory).st_mode) == 0o700
+	names = os.listdir(directory)
+	assert sorted(name.rsplit(".", 1)[1] for name in names) == ["json", "lock"]
+	for name in names:
+		assert stat.S_IMODE(os.stat(os.path.join(directory, name)).st_mode) == 0o600
+	coalescer.prune()
+	assert len(os.listdir(directory)) == 2		# Neither file is old yet
+	old = time.time() - single_flight.RESULT_AGE - 1
+	for name in names:
+		os.utime(os.path.join(directory, name), (old, old))
+	coalescer.prune()
+	assert [name.rsplit(".", 1)[1] for name in os.listdir(directory)] == ["lock"]
+	old = time.time() - single_flight.LOCK_AGE - 1
+	os.utime(os.path.join(directory, os.listdir(directory)[0]), (old, old))
+	coalescer.prune()
+	assert os.listdir(directory) == []